@@ -2,7 +2,13 @@ import os
 import sys
 import cv2
 import time
+import shutil
 import logging
+import functools
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from typing import Dict, List, Tuple, Optional, Union
 
@@ -12,6 +18,11 @@ from decord import VideoReader, cpu
 from tqdm import tqdm
 from transformers import AutoModel, AutoProcessor
 
+try:
+    from .model.cache_utils import LRUManifest, content_hash, read_json, write_json
+except ImportError:  # imported from avhaystacks/ as a plain module
+    from model.cache_utils import LRUManifest, content_hash, read_json, write_json
+
 # -------------------------------
 # Utility conversions
 # -------------------------------
@@ -31,13 +42,262 @@ def normalize_time_segment(seg: Union[Tuple[str, str], Dict[str, str]]) -> Tuple
     return time_to_seconds(s), time_to_seconds(e)
 
 
+def segments_to_frame_ranges(segs: List, fps: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Half-open native-frame ranges (starts, ends) covered by `segs`, in segment
+    order. Frames already covered by an earlier segment are cut out of later
+    ones, so overlapping segments never produce duplicate frames.
+    """
+    starts, ends = [], []
+    for seg in segs:
+        st, et = normalize_time_segment(seg)
+        pieces = [(lo, hi) for lo, hi in [(int(st * fps), int(et * fps))] if lo < hi]
+        for a, b in zip(starts, ends):
+            pieces = [
+                piece
+                for lo, hi in pieces
+                for piece in ((lo, min(hi, a)), (max(lo, b), hi))
+                if piece[0] < piece[1]
+            ]
+        for lo, hi in pieces:
+            starts.append(lo)
+            ends.append(hi)
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def frames_at_positions(starts: np.ndarray, ends: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Frame indices found at `positions` of the virtual concatenation of the
+    ranges [starts[k], ends[k]) without materializing it.
+    """
+    offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+    k = np.searchsorted(offsets, positions, side="right") - 1
+    return starts[k] + (positions - offsets[k])
+
+
+# -------------------------------
+# SFS dynamic program
+# -------------------------------
+
+@functools.lru_cache(maxsize=4)
+def length_penalty_matrix(n: int, length_penalty: float) -> np.ndarray:
+    """
+    Padded (n+1, n+1) SFS length-penalty matrix. The penalty only depends on
+    the distance |i - k| between two candidates, so it is evaluated once per
+    distance and gathered. Cached by (n, length_penalty); the result is
+    read-only and shared between callers.
+    """
+    dist = np.arange(n)
+    per_dist = (1 / (np.sin(1.5708 * dist / n) + 1) - 1) * length_penalty
+
+    P = np.zeros((n + 1, n + 1))
+    P[1:, 1:] = per_dist[np.abs(dist[:, None] - dist[None, :])]
+    P.setflags(write=False)
+    return P
+
+
+def _sfs_dp_loop(M: np.ndarray, P: Optional[np.ndarray], num_samples: int) -> np.ndarray:
+    """Reference DP: one Python iteration per (sample, candidate) cell."""
+    if P is None:
+        P = np.zeros_like(M)
+    n = M.shape[0] - 1
+    dp = np.full((n + 1, num_samples + 1), np.inf)
+    trace = np.full((n + 1, num_samples + 1), -1, dtype=int)
+    dp[0, 0] = 0.0
+
+    for j in range(1, num_samples + 1):
+        for i in range(j, n + 1):
+            temp = dp[j - 1:i, j - 1] + M[j - 1:i, i] + P[j - 1:i, i]
+            best = np.argmin(temp)
+            dp[i, j] = temp[best]
+            trace[i, j] = j - 1 + best
+
+    return trace
+
+
+def _sfs_dp_vectorized(M: np.ndarray, P: Optional[np.ndarray], num_samples: int, chunk_size: int = 128) -> np.ndarray:
+    """
+    Same recurrence as `_sfs_dp_loop`, but each DP column is solved with one
+    broadcast per block of at most `chunk_size` candidates. The matrices are
+    transposed once so every block reads contiguous memory. The summation order
+    and the first-minimum tie-break are kept, so the trace is identical to the
+    reference loop. A `P` of None means no length penalty and skips that pass.
+    """
+    n = M.shape[0] - 1
+    MT = np.ascontiguousarray(M.T)
+    PT = np.ascontiguousarray(P.T) if P is not None else None
+    dp = np.full((num_samples + 1, n + 1), np.inf)
+    trace = np.full((n + 1, num_samples + 1), -1, dtype=int)
+    dp[0, 0] = 0.0
+
+    # only candidates that leave room for the remaining samples can be on the path
+    slack = n - num_samples
+    # inside a block, predecessor c0 + r is invalid for candidate c0 + c when r >= c
+    invalid = np.tri(chunk_size, chunk_size, dtype=bool).T
+
+    for j in range(1, num_samples + 1):
+        prev = dp[j - 1]
+        last = j + slack
+        for c0 in range(j, last + 1, chunk_size):
+            c1 = min(c0 + chunk_size, last + 1)
+            width = c1 - c0
+            temp = np.add(prev[j - 1:c1 - 1], MT[c0:c1, j - 1:c1 - 1])
+            if PT is not None:
+                np.add(temp, PT[c0:c1, j - 1:c1 - 1], out=temp)
+            head = c0 - (j - 1)
+            temp[:, head:][invalid[:width, :width - 1]] = np.inf
+
+            best = np.argmin(temp, axis=1)
+            dp[j, c0:c1] = temp[np.arange(width), best]
+            trace[c0:c1, j] = j - 1 + best
+
+    return trace
+
+
+def sfs_dp_select(
+    M: np.ndarray,
+    P: Optional[np.ndarray],
+    num_samples: int,
+    engine: str = "vectorized",
+    chunk_size: int = 128
+) -> List[int]:
+    """
+    Run the SFS selection DP over the (N+1, N+1) padded similarity matrix `M`
+    and penalty matrix `P` (None for no penalty), and return the positions
+    (0-based, into the candidate list) of the `num_samples` chosen frames in
+    temporal order.
+    """
+    if engine == "vectorized":
+        trace = _sfs_dp_vectorized(M, P, num_samples, chunk_size=chunk_size)
+    elif engine == "loop":
+        trace = _sfs_dp_loop(M, P, num_samples)
+    else:
+        raise ValueError(f"Unknown sfs dp engine {engine}")
+
+    chosen = []
+    idx = M.shape[0] - 1
+    while idx > 0 and len(chosen) < num_samples:
+        chosen.append(idx - 1)
+        idx = trace[idx, num_samples - len(chosen) + 1]
+
+    return chosen[::-1]
+
+
+# ============================================================
+#                 FRAME FEATURE CACHE (on disk)
+# ============================================================
+
+class FrameFeatureCache:
+    """
+    Persistent per-frame CLIP feature store keyed by (video hash, frame index,
+    model, variant), where the variant names everything else that changes the
+    features (encoder backend, precision, decode path). Every entry is a
+    directory of `.npy` shards plus an `index.json` mapping frame index ->
+    (shard, row); shards are opened memory-mapped. Whole entries are evicted
+    least-recently-used once the store grows past `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 20 * 2 ** 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self._lru = LRUManifest(os.path.join(root, "lru.json"))
+        self.stats = self._lru.stats
+        self._lock = threading.Lock()
+
+    # --------------  keys --------------
+    @staticmethod
+    def video_hash(path: str) -> str:
+        return content_hash(path)
+
+    def _entry(self, video_hash: str, model_name: str, variant: str) -> str:
+        return os.path.join(model_name.replace("/", "--"), variant, video_hash)
+
+    # --------------  public api --------------
+    def lookup(self, video_hash: str, model_name: str, frame_idx, variant: str = "default") -> Dict[int, np.ndarray]:
+        """Return {frame index: feature} for every requested frame already stored."""
+        with self._lock:
+            return self._lookup(video_hash, model_name, frame_idx, variant)
+
+    def _lookup(self, video_hash: str, model_name: str, frame_idx, variant: str) -> Dict[int, np.ndarray]:
+        entry = self._entry(video_hash, model_name, variant)
+        index = read_json(os.path.join(self.root, entry, "index.json"))
+
+        found = {}
+        if index is not None:
+            shards = {}
+            for f in frame_idx:
+                loc = index["frames"].get(str(int(f)))
+                if loc is None:
+                    continue
+                shard, row = loc
+                if shard not in shards:
+                    shards[shard] = np.load(os.path.join(self.root, entry, index["shards"][shard]), mmap_mode="r")
+                found[int(f)] = shards[shard][row]
+            if found:
+                self._lru.touch(entry)
+                self._lru.save()
+
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(frame_idx) - len(found)
+        return found
+
+    def store(self, video_hash: str, model_name: str, frame_idx, feats: np.ndarray, variant: str = "default"):
+        """Append `feats` (one row per frame in `frame_idx`) as a new shard."""
+        with self._lock:
+            self._store(video_hash, model_name, frame_idx, feats, variant)
+
+    def _store(self, video_hash: str, model_name: str, frame_idx, feats: np.ndarray, variant: str):
+        entry = self._entry(video_hash, model_name, variant)
+        entry_dir = os.path.join(self.root, entry)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        index_path = os.path.join(entry_dir, "index.json")
+        index = read_json(index_path, {"shards": [], "frames": {}})
+        shard = len(index["shards"])
+        name = f"shard_{shard:05d}.npy"
+
+        feats = np.ascontiguousarray(feats)
+        np.save(os.path.join(entry_dir, name), feats)
+        index["shards"].append(name)
+        for row, f in enumerate(frame_idx):
+            index["frames"][str(int(f))] = [shard, row]
+        write_json(index_path, index)
+
+        self._lru.touch(entry, feats.nbytes)
+        for old in self._lru.evict(max_bytes=self.max_bytes, keep={entry}):
+            shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+        self._lru.save()
+
+
 # ============================================================
 #            SAMPLING MANAGER (fps / fixed / sfs)
 # ============================================================
 
 class SamplingController:
-    def __init__(self, clip_model_name: str = "openai/clip-vit-base-patch32"):
-        self.sampler = VideoFrameSampler(clip_model_name=clip_model_name)
+    def __init__(
+        self,
+        clip_model_name: str = "openai/clip-vit-base-patch32",
+        feature_cache_dir: Optional[str] = None,
+        feature_cache_max_gb: float = 20.0,
+        backend: Optional[str] = None,
+        precision: Optional[str] = None,
+        num_threads: Optional[int] = None
+    ):
+        """`backend`, `precision` and `num_threads` select the CLIP encoder, see VideoFrameSampler."""
+        feature_cache = None
+        if feature_cache_dir is not None:
+            feature_cache = FrameFeatureCache(feature_cache_dir, max_bytes=int(feature_cache_max_gb * 2 ** 30))
+        sampler_kwargs = {} if backend is None else {"device": "cuda" if backend == "cuda" else "cpu"}
+        self.sampler = VideoFrameSampler(
+            clip_model_name=clip_model_name,
+            feature_cache=feature_cache,
+            backend=backend,
+            precision=precision,
+            num_threads=num_threads,
+            **sampler_kwargs
+        )
 
     def convert_indices_to_segments(
         self,
@@ -121,9 +381,16 @@ class SamplingController:
             return merged
 
 
-    def sample_frames(self, vr, cfg: Dict, time_segments: Optional[List] = None) -> List[int]:
+    def sample_frames(
+        self,
+        vr,
+        cfg: Dict,
+        time_segments: Optional[List] = None,
+        video_path: Optional[str] = None
+    ) -> List[int]:
         """
         Dispatch sampler based on strategy: fps / fixed / sfs.
+        `video_path` lets sfs reuse cached frame features for `vr`.
         """
         strategy = cfg.get("sampling_strategy", "fixed")
         print(f"strategy: {strategy}")
@@ -133,10 +400,52 @@ class SamplingController:
         elif strategy == "fixed":
             return self._sample_fixed(vr, cfg["fixed_config"], time_segments)
         elif strategy == "sfs":
-            return self._sample_sfs(vr, cfg["sfs_config"], time_segments)
+            return self._sample_sfs(vr, cfg["sfs_config"], time_segments, video_path=video_path)
         else:
             raise ValueError(f"Unknown sampling strategy {strategy}")
 
+    def sample_frames_batch(
+        self,
+        videos: List,
+        cfgs: Union[Dict, List[Dict]],
+        time_segments: Optional[List[Optional[List]]] = None,
+        video_paths: Optional[List[Optional[str]]] = None,
+        max_batch: int = 64,
+        num_workers: int = 4
+    ) -> List[List[int]]:
+        """
+        Sample many videos at once; `cfgs` is one config for all videos or
+        one per video. Whole-video sfs jobs share packed encoder batches with
+        prefetched decoding (see VideoFrameSampler.sfs_sampling_batch); all
+        other jobs go through `sample_frames`. Returns indices per video.
+        """
+        if isinstance(cfgs, dict):
+            cfgs = [cfgs] * len(videos)
+        time_segments = time_segments or [None] * len(videos)
+        video_paths = video_paths or [v if isinstance(v, str) else None for v in videos]
+
+        results: List[Optional[List[int]]] = [None] * len(videos)
+        batched = [
+            i for i, (cfg, segs) in enumerate(zip(cfgs, time_segments))
+            if cfg.get("sampling_strategy", "fixed") == "sfs" and not segs
+        ]
+        if batched:
+            picked = self.sampler.sfs_sampling_batch(
+                [videos[i] for i in batched],
+                [cfgs[i]["sfs_config"] for i in batched],
+                video_paths=[video_paths[i] for i in batched],
+                max_batch=max_batch,
+                num_workers=num_workers
+            )
+            for i, chosen in zip(batched, picked):
+                results[i] = chosen
+
+        for i, (video, cfg, segs) in enumerate(zip(videos, cfgs, time_segments)):
+            if results[i] is None:
+                vr = self.sampler._get_reader(video)
+                results[i] = self.sample_frames(vr, cfg, segs, video_path=video_paths[i])
+        return results
+
     # ----------------------------------------------
     # Actual sampling methods
     # ----------------------------------------------
@@ -148,18 +457,16 @@ class SamplingController:
         if not segs:
             return self.sampler.fps_sampling(vr, tgt_fps)
 
-        # Collect frames inside target segments
-        all_idxs = []
-        native_fps = vr.get_avg_fps()
-        for s in segs:
-            f1 = int(time_to_seconds(s["start"]) * native_fps)
-            f2 = int(time_to_seconds(s["end"]) * native_fps)
-            all_idxs.extend(range(f1, f2))
+        # Stride over the frames inside target segments, by segment arithmetic
+        starts, ends = segments_to_frame_ranges(segs, vr.get_avg_fps())
+        total = int((ends - starts).sum())
 
-        interval = int(native_fps / tgt_fps)
-        samples = all_idxs[::interval]
+        interval = int(vr.get_avg_fps() / tgt_fps)
+        if interval < 1:
+            raise ValueError("target_fps > video_fps")
+        samples = frames_at_positions(starts, ends, np.arange(0, total, interval))
         print("fps, interval:", tgt_fps, interval)
-        return sorted(samples)
+        return sorted(samples.tolist())
 
     def _sample_fixed(self, vr, config: Dict, segs: Optional[List]) -> List[int]:
         n = config.get("num_frames", 8)
@@ -167,25 +474,22 @@ class SamplingController:
         if not segs:
             return self.sampler.fixed_sampling(vr, n)
 
-        # build a combined list of frames
-        frame_list = []
-        video_fps = vr.get_avg_fps()
-        for s in segs:
-            st = int(time_to_seconds(s["start"]) * video_fps)
-            et = int(time_to_seconds(s["end"]) * video_fps)
-            frame_list.extend(range(st, et))
+        # index the combined frames of all segments without building them
+        starts, ends = segments_to_frame_ranges(segs, vr.get_avg_fps())
+        total = int((ends - starts).sum())
 
-        if len(frame_list) < n:
-            print("len(all_segment_indices) < num_frames:", len(frame_list), n)
-            return sorted(frame_list)
+        if total < n:
+            print("len(all_segment_indices) < num_frames:", total, n)
+            return sorted(frames_at_positions(starts, ends, np.arange(total)).tolist())
 
-        idxs = np.linspace(0, len(frame_list) - 1, n, dtype=int)
+        idxs = np.linspace(0, total - 1, n, dtype=int)
         print("num_frames:", n)
-        return sorted([frame_list[i] for i in idxs])
+        return sorted(frames_at_positions(starts, ends, idxs).tolist())
 
-    def _sample_sfs(self, vr, config: Dict, segs: Optional[List]) -> List[int]:
+    def _sample_sfs(self, vr, config: Dict, segs: Optional[List], video_path: Optional[str] = None) -> List[int]:
         """
-        sfs wrapper – segmentation-aware sfs not implemented.
+        sfs wrapper – with segments, selection runs on the candidates inside
+        them, reusing the features of an earlier full-video sfs pass.
         """
         n = config.get("num_frames")
         kr = config.get("keep_ratio")
@@ -193,25 +497,124 @@ class SamplingController:
         init_fps = config.get("initial_fps")
         lp = config.get("length_penalty", 0.0)
         lp_exp = config.get("length_penalty_exponent", 1.0)
+        dp_engine = config.get("dp_engine", "vectorized")
+        dp_chunk = config.get("dp_chunk_size", 128)
+        max_decode_mb = config.get("max_decode_mb")
 
         print(
             f"num_frames={n}, keep_ratio={kr}, initial_frames={init_n}, "
-            f"initial_fps={init_fps}, length_penalty={lp}, exp={lp_exp}"
+            f"initial_fps={init_fps}, length_penalty={lp}, exp={lp_exp}, dp_engine={dp_engine}"
         )
 
-        if not segs:
-            return self.sampler.sfs_sampling(
-                vr,
-                num_samples=n,
-                keep_ratio=kr,
-                initial_frames=init_n,
-                initial_fps=init_fps,
-                length_penalty=lp,
-                length_penalty_exponent=lp_exp
-            )
+        return self.sampler.sfs_sampling(
+            vr,
+            num_samples=n,
+            keep_ratio=kr,
+            initial_frames=init_n,
+            initial_fps=init_fps,
+            length_penalty=lp,
+            length_penalty_exponent=lp_exp,
+            dp_engine=dp_engine,
+            dp_chunk_size=dp_chunk,
+            max_decode_mb=max_decode_mb,
+            video_path=video_path,
+            segments=segs
+        )
 
-        # identical logic as your original
-        assert False, "segmented sfs not yet implemented"
+
+# ============================================================
+#                  CLIP ENCODER BACKENDS
+# ============================================================
+
+def _load_clip_cuda(clip_model_name: str, device: str, precision: str = "float16", num_threads: Optional[int] = None):
+    """
+    GPU encoder, compiled when available: flash-attention 2 with `precision`
+    float16 / bfloat16, or SDPA attention in float32 (flash-attention 2 has
+    no float32 kernels).
+    """
+    dtypes = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+    if precision not in dtypes:
+        raise ValueError(f"Unknown cuda precision {precision}")
+
+    model = AutoModel.from_pretrained(
+        clip_model_name,
+        attn_implementation="sdpa" if precision == "float32" else "flash_attention_2",
+        device_map="cuda",
+        torch_dtype=dtypes[precision]
+    ).eval().to(device)
+
+    if torch.__version__ >= "2.0.0":
+        model = torch.compile(model)
+    return model
+
+
+def _load_clip_cpu(clip_model_name: str, device: str, precision: str = "float32", num_threads: Optional[int] = None):
+    """
+    CPU encoder: SDPA attention with `precision` one of float32 / bfloat16 /
+    int8 (dynamic quantization of the Linear layers).
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    if precision not in ("float32", "bfloat16", "int8"):
+        raise ValueError(f"Unknown cpu precision {precision}")
+
+    model = AutoModel.from_pretrained(
+        clip_model_name,
+        attn_implementation="sdpa",
+        torch_dtype=torch.bfloat16 if precision == "bfloat16" else torch.float32
+    ).eval().to("cpu")
+
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+CLIP_BACKENDS = {
+    "cuda": _load_clip_cuda,
+    "cpu": _load_clip_cpu,
+}
+
+
+_ENCODER_REGISTRY: Dict[Tuple, Tuple] = {}
+_ENCODER_REGISTRY_LOCK = threading.Lock()
+
+
+def get_clip_encoder(
+    clip_model_name: str,
+    backend: str,
+    device: str,
+    precision: Optional[str] = None,
+    num_threads: Optional[int] = None
+):
+    """
+    Process-wide registry of loaded (model, processor) pairs, so every sampler
+    with the same encoder settings shares one loaded, compiled model.
+    """
+    if backend not in CLIP_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend}")
+
+    key = (clip_model_name, backend, str(device), precision, num_threads)
+    with _ENCODER_REGISTRY_LOCK:
+        if key not in _ENCODER_REGISTRY:
+            kwargs = {"num_threads": num_threads}
+            if precision is not None:
+                kwargs["precision"] = precision
+            model = CLIP_BACKENDS[backend](clip_model_name, device, **kwargs)
+            model.eval()
+            processor = AutoProcessor.from_pretrained(clip_model_name)
+            _ENCODER_REGISTRY[key] = (model, processor)
+        return _ENCODER_REGISTRY[key]
+
+
+def benchmark_encoder(sampler, num_frames: int = 256, height: int = 360, width: int = 640, max_batch: int = 64) -> float:
+    """Encode `num_frames` random frames with `sampler` and return frames/sec."""
+    frames = list(np.random.randint(0, 256, (num_frames, height, width, 3), dtype=np.uint8))
+    sampler.encode_images(frames[:min(max_batch, num_frames)], max_batch=max_batch)  # warm-up
+
+    t0 = time.time()
+    sampler.encode_images(frames, max_batch=max_batch)
+    return num_frames / (time.time() - t0)
 
 
 # ============================================================
@@ -222,24 +625,51 @@ class VideoFrameSampler:
     def __init__(
         self,
         clip_model_name: Optional[str] = "openai/clip-vit-base-patch32",
-        device: str = "cuda" if torch.cuda.is_available() else "cpu"
+        device: str = "cuda" if torch.cuda.is_available() else "cpu",
+        feature_cache: Optional[FrameFeatureCache] = None,
+        backend: Optional[str] = None,
+        precision: Optional[str] = None,
+        num_threads: Optional[int] = None
     ):
+        """
+        `backend` picks a loader from CLIP_BACKENDS (default: "cuda" on a GPU
+        device, otherwise "cpu"); `precision` and `num_threads` are passed to
+        it, e.g. precision="int8" for quantized CPU encoding. The model is only
+        loaded on the first encode and shared through `get_clip_encoder`.
+        """
         self.device = device
+        self.backend = backend or ("cuda" if str(device).startswith("cuda") else "cpu")
+        if self.backend not in CLIP_BACKENDS:
+            raise ValueError(f"Unknown encoder backend {self.backend}")
+        self.clip_model_name = clip_model_name
+        self.feature_cache = feature_cache
         self.logger = logging.getLogger(__name__)
+        self.last_timings: Dict[str, float] = {}
+        self.last_memory: Dict[str, float] = {}
+        self._coarse = None
+
+        self.precision = precision
+        self.num_threads = num_threads
+        self._encoder = None
+
+    # --------------  lazy encoder  --------------
+    def _load_encoder(self):
+        if self._encoder is None:
+            if self.clip_model_name is None:
+                raise ValueError("VideoFrameSampler was created without a clip model")
+            self._encoder = get_clip_encoder(
+                self.clip_model_name, self.backend, self.device, self.precision, self.num_threads
+            )
+        return self._encoder
 
-        if clip_model_name is not None:
-            self.model = AutoModel.from_pretrained(
-                clip_model_name,
-                attn_implementation="flash_attention_2",
-                device_map="cuda",
-                torch_dtype=torch.float16
-            ).eval().to(device)
-
-            if torch.__version__ >= "2.0.0":
-                self.model = torch.compile(self.model)
+    @property
+    def model(self):
+        """CLIP model, loaded (or taken from the registry) on first use."""
+        return self._load_encoder()[0]
 
-            self.processor = AutoProcessor.from_pretrained(clip_model_name)
-            self.model.eval()
+    @property
+    def processor(self):
+        return self._load_encoder()[1]
 
     # --------------  image encoding  --------------
     def encode_images(self, imgs, max_batch: int = 64):
@@ -261,6 +691,115 @@ class VideoFrameSampler:
             self.logger.error(f"Encoding failure: {e}")
             raise
 
+    def encode_frames_streaming(self, vr, frame_idx, max_decode_mb: float = 512, max_batch: int = 64):
+        """
+        Decode `frame_idx` from `vr` in chunks whose full-resolution size stays
+        under `max_decode_mb`, shrink each chunk to CLIP input resolution and
+        encode it right away. Only the feature matrix outlives a chunk. The
+        peak decode buffer and feature size are stored in `self.last_memory`.
+        """
+        try:
+            load_time, encode_time, peak, chunk = 0.0, 0.0, 0, 0
+            feats = []
+            t0 = time.time()
+            for frames, raw_bytes in self._decode_chunks(vr, frame_idx, max_decode_mb):
+                peak = max(peak, raw_bytes)
+                chunk = max(chunk, len(frames))
+                load_time += time.time() - t0
+
+                t1 = time.time()
+                feats.append(self.encode_images(frames, max_batch=max_batch).cpu())
+                encode_time += time.time() - t1
+                del frames
+                t0 = time.time()
+
+            feats = torch.cat(feats, dim=0)
+            self.last_timings["load"] = self.last_timings.get("load", 0.0) + load_time
+            self.last_timings["encode"] = self.last_timings.get("encode", 0.0) + encode_time
+            self.last_memory = {
+                "decode_chunk_frames": chunk,
+                "peak_decode_mb": peak / 2 ** 20,
+                "features_mb": feats.numel() * feats.element_size() / 2 ** 20,
+            }
+            return feats
+
+        except Exception as e:
+            self.logger.error(f"Streaming encoding failure: {e}")
+            raise
+
+    def _decode_chunks(self, vr, frame_idx, max_decode_mb: float):
+        """
+        Yield (frames, raw bytes) for `frame_idx` in chunks whose full-resolution
+        size stays under `max_decode_mb`; frames are already shrunk to CLIP
+        input resolution, so only the raw chunk is ever held at full size.
+        """
+        edge = self.processor.image_processor.size.get("shortest_edge", 224)
+        frame_bytes = vr[int(frame_idx[0])].asnumpy().nbytes
+        chunk = max(1, int(max_decode_mb * 2 ** 20 // frame_bytes))
+        for i in range(0, len(frame_idx), chunk):
+            frames = vr.get_batch(frame_idx[i:i + chunk]).asnumpy()
+            raw_bytes = frames.nbytes
+            h, w = frames.shape[1:3]
+            scale = edge / min(h, w)
+            if scale < 1:
+                size = (max(edge, round(w * scale)), max(edge, round(h * scale)))
+                frames = [cv2.resize(f, size, interpolation=cv2.INTER_AREA) for f in frames]
+            else:
+                frames = list(frames)
+            yield frames, raw_bytes
+
+    def encode_frames(self, vr, frame_idx, video_path: Optional[str] = None, max_decode_mb: Optional[float] = None):
+        """
+        Encode frames `frame_idx` of `vr`, one feature row per index. When a
+        feature cache is configured and `video_path` is known, cached frames
+        are read back and only the missing ones are decoded and encoded.
+        """
+        try:
+            t0 = time.time()
+            video_hash, cached = None, {}
+            variant = self._cache_variant(resized=max_decode_mb is not None)
+            if self.feature_cache is not None and video_path is not None:
+                video_hash = FrameFeatureCache.video_hash(video_path)
+                cached = self.feature_cache.lookup(video_hash, self.clip_model_name, frame_idx, variant)
+            missing = np.array([f for f in frame_idx if int(f) not in cached], dtype=int)
+
+            new_feats = None
+            if len(missing) and max_decode_mb is not None:
+                self.last_timings["load"] = self.last_timings.get("load", 0.0) + time.time() - t0
+                new_feats = self.encode_frames_streaming(vr, missing, max_decode_mb=max_decode_mb)
+            elif len(missing):
+                frames_np = vr.get_batch(missing).asnumpy()
+                t1 = time.time()
+                self.last_timings["load"] = self.last_timings.get("load", 0.0) + t1 - t0
+                new_feats = self.encode_images(frames_np)
+                self.last_timings["encode"] = self.last_timings.get("encode", 0.0) + time.time() - t1
+            else:
+                self.last_timings["load"] = self.last_timings.get("load", 0.0) + time.time() - t0
+
+            return self._merge_cached(frame_idx, missing, new_feats, cached, video_hash, variant)
+
+        except Exception as e:
+            self.logger.error(f"Frame encoding failure: {e}")
+            raise
+
+    def _cache_variant(self, resized: bool) -> str:
+        """
+        Feature-cache variant of this encoder: backend, precision and whether
+        frames were shrunk by `_decode_chunks` before the CLIP processor.
+        """
+        return f"{self.backend}-{self.precision or 'default'}-{'resized' if resized else 'full'}"
+
+    def _merge_cached(self, frame_idx, missing, new_feats, cached, video_hash=None, variant="default"):
+        """Store freshly encoded rows and return all rows in `frame_idx` order."""
+        if new_feats is not None and video_hash is not None:
+            self.feature_cache.store(video_hash, self.clip_model_name, missing, new_feats.float().cpu().numpy(), variant)
+        if not cached:
+            return new_feats
+
+        rows = dict(zip(missing.tolist(), new_feats.float().cpu())) if new_feats is not None else {}
+        rows.update({f: torch.from_numpy(np.array(v)) for f, v in cached.items()})
+        return torch.stack([rows[int(f)] for f in frame_idx]).to(self.device)
+
     # --------------  helper --------------
     def _get_reader(self, v):
         if isinstance(v, str):
@@ -282,81 +821,55 @@ class VideoFrameSampler:
         initial_fps=None,
         length_penalty=0.0,
         length_penalty_exponent=1.0,
+        dp_engine="vectorized",
+        dp_chunk_size=128,
+        max_decode_mb=None,
+        video_path=None,
+        segments=None,
     ):
+        """
+        Select `num_samples` (or `keep_ratio` of the candidates) frames by SFS.
+        With `max_decode_mb` set, candidates are decoded and encoded in chunks
+        bounded by that many MB of raw frames instead of all at once.
+        `video_path` (implied when `video` is a path) enables the feature cache.
+        With `segments`, selection is restricted to those time segments and
+        reuses the candidates of the last full-video pass over the same video.
+        """
         try:
+            self.last_timings = {}
+            self.last_memory = {}
             t0 = time.time()
+            if isinstance(video, str):
+                video_path = video
             vr = self._get_reader(video)
-            total_frames = len(vr)
-            fps = vr.get_avg_fps()
-
-            # Decide initial sampling technique
-            if initial_fps is not None:
-                steps = round(fps / initial_fps)
-                init_idx = np.arange(0, total_frames, steps, dtype=int)
-            else:
-                if initial_frames is None:
-                    initial_frames = min(total_frames, num_samples * 2 if num_samples else int(total_frames * 0.5))
-                init_idx = np.linspace(0, total_frames - 1, initial_frames, dtype=int)
-
-            frames_np = vr.get_batch(init_idx).asnumpy()
-            print(f"Video load: {time.time() - t0:.2f}s")
 
-            # Decide target count
             if num_samples is None and keep_ratio is None:
                 raise ValueError("Need num_samples or keep_ratio")
 
-            if keep_ratio is not None:
-                num_samples = max(1, int(len(init_idx) * keep_ratio))
-            else:
-                num_samples = min(num_samples, len(init_idx))
-
-            # Extract features
-            t1 = time.time()
+            self.last_timings["load"] = time.time() - t0
             with torch.inference_mode():
-                feats = self.encode_images(frames_np)
-                flat = feats.view(len(init_idx), -1)
-                norm = torch.nn.functional.normalize(flat, p=2, dim=1).float()
-                sim_mat = torch.mm(norm, norm.t()).cpu().numpy()
-
-            print(f"Feature extraction: {time.time() - t1:.2f}s")
-
-            M = np.zeros((len(init_idx) + 1, len(init_idx) + 1))
-            M[1:, 1:] = sim_mat
-
-            # Length penalty precompute
-            penalties = np.array([
-                ((1 / (torch.sin(1.5708 * abs(i - k) / len(init_idx)) + 1) - 1) * length_penalty)
-                for i in range(len(init_idx))
-                for k in range(len(init_idx))
-            ]).reshape(len(init_idx), len(init_idx))
-
-            P = np.zeros_like(M)
-            P[1:, 1:] = penalties
-
-            # DP selection
-            t2 = time.time()
-            dp = np.full((len(init_idx) + 1, num_samples + 1), np.inf)
-            trace = np.full((len(init_idx) + 1, num_samples + 1), -1, dtype=int)
-            dp[0, 0] = 0.0
-
-            for j in range(1, num_samples + 1):
-                for i in range(j, len(init_idx) + 1):
-                    temp = dp[j - 1:i, j - 1] + M[j - 1:i, i] + P[j - 1:i, i]
-                    best = np.argmin(temp)
-                    dp[i, j] = temp[best]
-                    trace[i, j] = j - 1 + best
-
-            chosen = []
-            idx = len(init_idx)
-            while idx > 0 and len(chosen) < num_samples:
-                chosen.append(init_idx[idx - 1])
-                idx = trace[idx, num_samples - len(chosen) + 1]
-
-            chosen = chosen[::-1]
-            print(f"DP time: {time.time() - t2:.2f}s")
-
-            if len(chosen) < num_samples:
-                raise ValueError("Insufficient frames selected.")
+                if segments:
+                    init_idx, feats = self._segment_candidates(
+                        vr, segments, num_samples, initial_frames, initial_fps, video_path, max_decode_mb
+                    )
+                else:
+                    init_idx = self._initial_candidates(vr, num_samples, initial_frames, initial_fps)
+
+                    # Extract features (cached frames are not decoded again)
+                    feats = self.encode_frames(vr, init_idx, video_path=video_path, max_decode_mb=max_decode_mb)
+                    self._coarse = {"reader": vr, "path": video_path, "idx": init_idx, "feats": feats}
+
+            print(f"Video load: {self.last_timings['load']:.2f}s")
+            if self.last_memory:
+                print(
+                    f"peak decode buffer: {self.last_memory['peak_decode_mb']:.1f}MB "
+                    f"({self.last_memory['decode_chunk_frames']} frames/chunk)"
+                )
+            print(f"Feature extraction: {self.last_timings.get('encode', 0.0):.2f}s")
+            if self.feature_cache is not None:
+                print(f"Feature cache: {self.feature_cache.stats}")
+
+            chosen = self._sfs_select(init_idx, feats, num_samples, keep_ratio, length_penalty, dp_engine, dp_chunk_size)
 
             torch.cuda.empty_cache()
             return chosen
@@ -365,6 +878,270 @@ class VideoFrameSampler:
             self.logger.error(f"sfs_sampling failed: {e}")
             raise
 
+    def sfs_sampling_batch(
+        self,
+        videos: List,
+        configs: List[Dict],
+        video_paths: Optional[List[Optional[str]]] = None,
+        max_batch: int = 64,
+        num_workers: int = 4,
+        prefetch: Optional[int] = None,
+        max_decode_mb: Optional[float] = None,
+    ) -> List[List[int]]:
+        """
+        Whole-video SFS over many videos. Candidates of upcoming videos are
+        decoded on a thread pool (at most `prefetch` videos at a time) while
+        the encoder runs, and encoder batches are packed with frames from
+        several videos, so batches hold `max_batch` frames unless the memory
+        budget forces an early flush. `configs` are `sfs_config` dicts, one
+        per video. Returns the chosen frame indices per video, in input order.
+
+        Decoding is bounded by `max_decode_mb` (default: the smallest
+        `max_decode_mb` of the configs, else 512): half of it is split between
+        the workers' full-resolution decode chunks, the other half caps the
+        downscaled frames of all prefetched videos waiting for the encoder.
+        """
+        try:
+            self.last_timings = {}
+            self.last_memory = {}
+            prefetch = min(num_workers, prefetch or num_workers)
+            if any(cfg.get("num_frames") is None and cfg.get("keep_ratio") is None for cfg in configs):
+                raise ValueError("Need num_samples or keep_ratio")
+            if video_paths is None:
+                video_paths = [v if isinstance(v, str) else None for v in videos]
+            if max_decode_mb is None:
+                budgets = [cfg["max_decode_mb"] for cfg in configs if cfg.get("max_decode_mb") is not None]
+                max_decode_mb = min(budgets) if budgets else 512
+            chunk_mb = max_decode_mb / 2 / prefetch
+            buffer_bytes = max_decode_mb / 2 * 2 ** 20
+
+            variant = self._cache_variant(resized=True)  # workers always decode through _decode_chunks
+            results: List[Optional[List[int]]] = [None] * len(videos)
+            states = {}
+            ready = queue.Queue()  # (video, frames | None when decoded | "flush" | exception)
+            budget = threading.Condition()
+            held = {"bytes": 0, "peak": 0, "raw_peak": 0, "abort": False}
+
+            def decode(i):
+                try:
+                    if held["abort"]:
+                        return
+                    cfg = configs[i]
+                    vr = self._get_reader(videos[i])
+                    init_idx = self._initial_candidates(vr, cfg.get("num_frames"), cfg.get("initial_frames"), cfg.get("initial_fps"))
+                    video_hash, cached = None, {}
+                    if self.feature_cache is not None and video_paths[i] is not None:
+                        video_hash = FrameFeatureCache.video_hash(video_paths[i])
+                        cached = self.feature_cache.lookup(video_hash, self.clip_model_name, init_idx, variant)
+                    missing = np.array([f for f in init_idx if int(f) not in cached], dtype=int)
+                    states[i] = {"idx": init_idx, "missing": missing, "cached": cached, "hash": video_hash, "parts": [], "decoded": False}
+
+                    if len(missing):
+                        for frames, raw_bytes in self._decode_chunks(vr, missing, chunk_mb):
+                            nbytes = sum(f.nbytes for f in frames)
+                            with budget:
+                                # a chunk is always admitted into an empty buffer, so progress never stalls
+                                fits = lambda: held["abort"] or held["bytes"] == 0 or held["bytes"] + nbytes <= buffer_bytes
+                                while not fits():
+                                    ready.put((i, "flush"))  # ask the encoder for a (partial) batch
+                                    budget.wait()
+                                if held["abort"]:
+                                    return
+                                held["bytes"] += nbytes
+                                held["peak"] = max(held["peak"], held["bytes"])
+                                held["raw_peak"] = max(held["raw_peak"], raw_bytes)
+                            ready.put((i, frames))
+                    ready.put((i, None))
+                except Exception as e:
+                    ready.put((i, e))
+
+            pending = deque()  # (video, frames not yet encoded)
+            buffered = 0
+
+            def finalize(i):
+                st = states.pop(i)
+                new_feats = torch.cat(st["parts"], dim=0) if st["parts"] else None
+                feats = self._merge_cached(st["idx"], st["missing"], new_feats, st["cached"], st["hash"], variant)
+                cfg = configs[i]
+                results[i] = self._sfs_select(
+                    st["idx"], feats, cfg.get("num_frames"), cfg.get("keep_ratio"), cfg.get("length_penalty", 0.0),
+                    cfg.get("dp_engine", "vectorized"), cfg.get("dp_chunk_size", 128)
+                )
+
+            def encode_batch():
+                nonlocal buffered
+                owners, frames = [], []
+                while pending and len(frames) < max_batch:
+                    i, rest = pending[0]
+                    take = rest[:max_batch - len(frames)]
+                    frames.extend(take)
+                    owners.append((i, len(take)))
+                    if len(take) == len(rest):
+                        pending.popleft()
+                    else:
+                        pending[0] = (i, rest[len(take):])
+                buffered -= len(frames)
+
+                t1 = time.time()
+                with torch.inference_mode():
+                    feats = self.encode_images(frames, max_batch=max_batch)
+                self.last_timings["encode"] = self.last_timings.get("encode", 0.0) + time.time() - t1
+                self.last_timings["batches"] = self.last_timings.get("batches", 0) + 1
+                with budget:
+                    held["bytes"] -= sum(f.nbytes for f in frames)
+                    budget.notify_all()
+                del frames
+
+                row = 0
+                for i, n in owners:
+                    states[i]["parts"].append(feats[row:row + n])
+                    row += n
+                    maybe_finalize(i)
+
+            def maybe_finalize(i):
+                st = states[i]
+                if st["decoded"] and sum(len(p) for p in st["parts"]) == len(st["missing"]):
+                    finalize(i)
+
+            with ThreadPoolExecutor(max_workers=prefetch) as pool:
+                for i in range(len(videos)):
+                    pool.submit(decode, i)
+
+                try:
+                    done = 0
+                    flush = False  # a decoder asked for a batch before any frames were buffered
+                    while done < len(videos):
+                        t0 = time.time()
+                        i, item = ready.get()
+                        self.last_timings["decode_wait"] = self.last_timings.get("decode_wait", 0.0) + time.time() - t0
+
+                        if isinstance(item, Exception):
+                            raise item
+                        if isinstance(item, str):
+                            # a decoder is waiting on the buffer budget; its blocking frames may still be in flight
+                            flush = True
+                        elif item is None:
+                            states[i]["decoded"] = True
+                            done += 1
+                            maybe_finalize(i)
+                            continue
+                        else:
+                            pending.append((i, item))
+                            buffered += len(item)
+                            while buffered >= max_batch:
+                                encode_batch()
+                                flush = False
+                        if flush and buffered:
+                            encode_batch()
+                            flush = False
+
+                    while buffered:
+                        encode_batch()
+                finally:
+                    # release decoders blocked on the budget before the pool joins them
+                    with budget:
+                        held["abort"] = True
+                        budget.notify_all()
+
+            self.last_memory = {
+                "budget_mb": max_decode_mb,
+                "peak_decode_mb": held["raw_peak"] / 2 ** 20,
+                "peak_buffered_mb": held["peak"] / 2 ** 20,
+            }
+            print(
+                f"Batch sfs over {len(videos)} videos: decode wait {self.last_timings.get('decode_wait', 0.0):.2f}s, "
+                f"encode {self.last_timings.get('encode', 0.0):.2f}s in {self.last_timings.get('batches', 0)} batches, "
+                f"dp {self.last_timings.get('dp', 0.0):.2f}s, "
+                f"peak buffered frames {self.last_memory['peak_buffered_mb']:.1f}MB of {max_decode_mb:.0f}MB budget"
+            )
+            torch.cuda.empty_cache()
+            return results
+
+        except Exception as e:
+            self.logger.error(f"sfs_sampling_batch failed: {e}")
+            raise
+
+    def _initial_candidates(self, vr, num_samples, initial_frames, initial_fps) -> np.ndarray:
+        """Candidate frame indices over the whole video."""
+        total_frames = len(vr)
+
+        # Decide initial sampling technique
+        if initial_fps is not None:
+            steps = round(vr.get_avg_fps() / initial_fps)
+            return np.arange(0, total_frames, steps, dtype=int)
+
+        if initial_frames is None:
+            initial_frames = min(total_frames, num_samples * 2 if num_samples else int(total_frames * 0.5))
+        return np.linspace(0, total_frames - 1, initial_frames, dtype=int)
+
+    def _sfs_select(self, init_idx, feats, num_samples, keep_ratio, length_penalty, dp_engine, dp_chunk_size) -> List[int]:
+        """Run the SFS DP on candidate features and return the chosen frame indices."""
+        # Decide target count
+        if keep_ratio is not None:
+            num_samples = max(1, int(len(init_idx) * keep_ratio))
+        else:
+            num_samples = min(num_samples, len(init_idx))
+
+        with torch.inference_mode():
+            flat = feats.view(len(init_idx), -1)
+            norm = torch.nn.functional.normalize(flat, p=2, dim=1).float()
+            sim_mat = torch.mm(norm, norm.t()).cpu().numpy()
+
+        M = np.zeros((len(init_idx) + 1, len(init_idx) + 1))
+        M[1:, 1:] = sim_mat
+
+        # Length penalty precompute (skipped for the default of 0)
+        P = length_penalty_matrix(len(init_idx), float(length_penalty)) if length_penalty else None
+
+        # DP selection
+        t2 = time.time()
+        picked = sfs_dp_select(M, P, num_samples, engine=dp_engine, chunk_size=dp_chunk_size)
+        chosen = [init_idx[p] for p in picked]
+        self.last_timings["dp"] = self.last_timings.get("dp", 0.0) + time.time() - t2
+        print(f"DP time ({dp_engine}): {time.time() - t2:.2f}s")
+
+        if len(chosen) < num_samples:
+            raise ValueError("Insufficient frames selected.")
+        return chosen
+
+    def _segment_candidates(self, vr, segments, num_samples, initial_frames, initial_fps, video_path, max_decode_mb):
+        """
+        Candidate frame indices and features inside `segments`. Candidates of
+        the last full-video pass over the same video are reused as is; only
+        when there are none (or none fall inside the segments) are frames
+        decoded and encoded for the segments alone.
+        """
+        fps = vr.get_avg_fps()
+        starts, ends = segments_to_frame_ranges(segments, fps)
+        ends = np.minimum(ends, len(vr))
+        valid = starts < ends
+        if not valid.any():
+            raise ValueError(f"No frames inside time segments {segments} (video has {len(vr)} frames at {fps:.2f} fps)")
+        starts, ends = starts[valid], ends[valid]
+
+        coarse = self._coarse
+        if coarse is not None and (coarse["reader"] is vr or (video_path is not None and coarse["path"] == video_path)):
+            mask = np.zeros(len(coarse["idx"]), dtype=bool)
+            for f1, f2 in zip(starts, ends):
+                mask |= (coarse["idx"] >= f1) & (coarse["idx"] < f2)
+            if mask.any():
+                keep = torch.from_numpy(np.flatnonzero(mask)).to(coarse["feats"].device)
+                print(f"segmented sfs: reusing {int(mask.sum())} coarse candidates")
+                return coarse["idx"][mask], coarse["feats"][keep]
+
+        if initial_fps is not None:
+            steps = max(1, round(fps / initial_fps))
+            init_idx = np.unique(np.concatenate([np.arange(f1, f2, steps, dtype=int) for f1, f2 in zip(starts, ends)]))
+        else:
+            total = int((ends - starts).sum())
+            if initial_frames is None:
+                initial_frames = min(total, num_samples * 2 if num_samples else max(1, int(total * 0.5)))
+            positions = np.linspace(0, total - 1, initial_frames, dtype=int)
+            init_idx = np.unique(frames_at_positions(starts, ends, positions))
+
+        feats = self.encode_frames(vr, init_idx, video_path=video_path, max_decode_mb=max_decode_mb)
+        return init_idx, feats
+
     # ======================================================
     #                FPS SAMPLING
     # ======================================================
@@ -399,3 +1176,28 @@ class VideoFrameSampler:
         except Exception as e:
             self.logger.error(f"fixed_sampling error: {e}")
             raise
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="CLIP frame encoder throughput")
+    parser.add_argument("--clip_model_name", type=str, default="openai/clip-vit-base-patch32")
+    parser.add_argument("--backend", type=str, default=None, choices=list(CLIP_BACKENDS))
+    parser.add_argument("--precision", type=str, default=None, help="float16 / bfloat16 / float32 (cuda), float32 / bfloat16 / int8 (cpu).")
+    parser.add_argument("--num_threads", type=int, default=None, help="Torch intra-op threads for the cpu backend.")
+    parser.add_argument("--num_frames", type=int, default=256)
+    parser.add_argument("--max_batch", type=int, default=64)
+    args = parser.parse_args()
+
+    device = "cuda" if args.backend in (None, "cuda") and torch.cuda.is_available() else "cpu"
+    sampler = VideoFrameSampler(
+        clip_model_name=args.clip_model_name,
+        device=device,
+        backend=args.backend,
+        precision=args.precision,
+        num_threads=args.num_threads
+    )
+    fps = benchmark_encoder(sampler, num_frames=args.num_frames, max_batch=args.max_batch)
+    print(f"backend={sampler.backend}, precision={args.precision}, threads={torch.get_num_threads()}: {fps:.1f} frames/sec")
@@ -1,8 +1,10 @@
 import os
 import glob
-import math
 import json
+import time
+import hashlib
 import argparse
+from clipping import get_duration
 from model.QwenOmni import Qwen2_5OMNI
 
 """
@@ -18,63 +20,161 @@ User Question: [Insert specific query]
 
 PROMPT = "Please analyze both video and audio content using this two-step process:\n1. Determine if the question is answerable based on the video and audio. If unrelated, respond ONLY with 'Unanswerable'.\n2. If answerable:\n- Provide a concise answer using timestamps from the video\n- Format timestamps as [HH:MM:SS-HH:MM:SS] in brackets\nUser Question: {Question}"
 
+def segment_filenames(source, retrieved_file, video_vocabs):
+    """Segments of `retrieved_file` to run the model on, sorted by name."""
+    if "retrieved_segments" in source:
+        # segment-level retrieval already picked the segments to look at
+        filenames = list(source["retrieved_segments"][retrieved_file])
+    else:
+        filenames = [os.path.splitext(os.path.basename(filename))[0] for filename in glob.glob(os.path.join(video_vocabs, f"{retrieved_file}__*.mp4"))]
+    filenames.sort()
+    return filenames
+
+def build_jobs(sources, args):
+    """
+    Flatten every (question, retrieved file, segment) into one job list sorted
+    by segment duration, so each batch holds similarly long clips (little
+    padding) and every batch but the last is full.
+    Returns:
+        jobs: list of dict {source, retrieved_file, filename, duration}
+        agent_answers: per-source {retrieved_file: {filename: None}} skeletons
+    """
+    jobs, agent_answers, durations = [], [], {}
+    for idx, source in enumerate(sources):
+        answers = {}
+        for retrieved_file in source["retrieved_file"]:
+            filenames = segment_filenames(source, retrieved_file, args.video_vocabs)
+            answers[retrieved_file] = {filename: None for filename in filenames}
+            for filename in filenames:
+                if filename not in durations:
+                    try:
+                        durations[filename] = get_duration(os.path.join(args.video_vocabs, f"{filename}.mp4"))
+                    except (OSError, ValueError):
+                        durations[filename] = 0.0  # unknown length: ffprobe missing or unreadable file
+                jobs.append({"source": idx, "retrieved_file": retrieved_file, "filename": filename, "duration": durations[filename]})
+        agent_answers.append(answers)
+
+    jobs.sort(key = lambda job: (job["duration"], job["filename"], job["source"]))
+    return jobs, agent_answers
+
+def plan_batches(jobs, bsz, group_segments = False):
+    """
+    Split the job queue into batches of at most `bsz`. With `group_segments`,
+    all questions on one segment (gathered from the whole queue) form their
+    own batches so they share one prefix prefill, and segments asked about
+    once are packed together into full batches.
+    """
+    if not group_segments:
+        return [jobs[i:i + bsz] for i in range(0, len(jobs), bsz)]
+
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job["filename"], []).append(job)
+    batches, singles = [], []
+    for group in groups.values():
+        if len(group) == 1:
+            singles.extend(group)
+        else:
+            batches.extend(group[i:i + bsz] for i in range(0, len(group), bsz))
+    batches.extend(singles[i:i + bsz] for i in range(0, len(singles), bsz))
+    return batches
+
+def job_key(source, filename, prompt_hash, model_name):
+    """Journal key of one answer: (question id, segment filename, prompt hash, model)."""
+    return (str(source.get("id", source["question"])), filename, prompt_hash, model_name)
+
+def load_journal(path):
+    """
+    {job key: answer} for every complete line of a results journal. A last
+    line cut off by a crash mid-write is dropped from the file, so appending
+    can continue after it.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'rb+') as f:
+        data = f.read()
+        f.truncate(data.rfind(b"\n") + 1)
+    for line in data[:data.rfind(b"\n") + 1].splitlines():
+        record = json.loads(line)
+        done[(record["id"], record["filename"], record["prompt"], record["model"])] = record["answer"]
+    return done
+
 def main(args):
     
     bsz = args.bsz
-    model = Qwen2_5OMNI(model_name = args.model_name, prompt = PROMPT)
+    preprocess_cache = None
+    if args.mm_cache_dir is not None or args.mm_cache_mem_gb > 0:
+        preprocess_cache = {
+            "root": args.mm_cache_dir,
+            "mem_max_bytes": int(args.mm_cache_mem_gb * 2 ** 30),
+            "disk_max_bytes": int(args.mm_cache_disk_gb * 2 ** 30),
+        }
+    model = Qwen2_5OMNI(model_name = args.model_name, prompt = PROMPT, preprocess_cache = preprocess_cache)
 
     with open(args.retrieve_pth, 'r') as f:
         sources = json.load(f)
-    
+
+    # one global queue over all questions, filled into full batches
+    jobs, agent_answers = build_jobs(sources, args)
+
+    # every batch is appended to the journal, so --resume only runs the missing jobs
+    journal_pth = args.journal or f"{os.path.splitext(args.output)[0]}.jsonl"
+    # --prefix_cache puts the media before the question, so it is a different prompt
+    prompt_hash = hashlib.sha1((PROMPT + ("|media-first" if args.prefix_cache else "")).encode()).hexdigest()[:12]
+    for job in jobs:
+        job["key"] = job_key(sources[job["source"]], job["filename"], prompt_hash, args.model_name)
+    if args.resume:
+        done = load_journal(journal_pth)
+        for job in jobs:
+            if job["key"] in done:
+                agent_answers[job["source"]][job["retrieved_file"]][job["filename"]] = done[job["key"]]
+        print(f"Resuming: {sum(job['key'] in done for job in jobs)} of {len(jobs)} segments already answered")
+        jobs = [job for job in jobs if job["key"] not in done]
+    journal = open(journal_pth, 'a' if args.resume else 'w')
+
+    start = time.time()
+    done = 0
+    for batch_jobs in plan_batches(jobs, bsz, group_segments = args.prefix_cache):
+
+        inputs = [
+            {
+                "text": sources[job["source"]]["question"],
+                "audio": os.path.join(args.audio_vocabs, f"{job['filename']}.wav"),
+                "video": os.path.join(args.video_vocabs, f"{job['filename']}.mp4")
+            }
+            for job in batch_jobs
+        ]
+        if args.prefix_cache:
+            text = model.generate_grouped(inputs)
+        else:
+            inputs = model.prepare_input(inputs)
+            text, _ = model.generate(inputs)
+
+        for job, t in zip(batch_jobs, text):
+            agent_answers[job["source"]][job["retrieved_file"]][job["filename"]] = t
+            qid, filename, prompt, model_name = job["key"]
+            journal.write(json.dumps({"id": qid, "filename": filename, "prompt": prompt, "model": model_name, "answer": t}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+        done += len(batch_jobs)
+        print(f"[{done}/{len(jobs)}] {done / (time.time() - start):.3f} segments/sec")
+
+    journal.close()
+    elapsed = time.time() - start
+    print(f"Answered {len(jobs)} segments in {elapsed:.1f}s ({len(jobs) / max(elapsed, 1e-9):.3f} segments/sec)")
+    if model.preprocess_cache is not None:
+        print(f"Preprocessing cache: {model.preprocess_cache.stats}")
+
+    # compact the journal into the usual output format
     targets = []
-    for source in sources:
-
-        question = source["question"]
-        retrieved_files = source["retrieved_file"]
-        agent_answers = {}
-        
-        for retrieved_file in retrieved_files:
-
-            filenames = [os.path.splitext(os.path.basename(filename))[0] for filename in glob.glob(os.path.join(args.video_vocabs, f"{retrieved_file}__*.mp4"))]
-            filenames.sort()
-
-            # inputs = [
-            #     {
-            #         "text": question,
-            #         "audio": os.path.join(args.audio_vocabs, f"{filename}.wav"),
-            #         "video": os.path.join(args.video_vocabs, f"{filename}.mp4")
-            #     }
-            #     for filename in filenames
-            # ]
-
-            # inputs = model.prepare_input(inputs)
-            # text, _ = model.generate(inputs)
-            
-            # answers = {filaname: t for filaname, t in zip(filenames, text)}
-            texts = []
-            for i in range(math.ceil(len(filenames) / bsz)):
-                
-                batch_filenames = filenames[i * bsz:(i + 1) * bsz]
-                inputs = [
-                    {
-                        "text": question,
-                        "audio": os.path.join(args.audio_vocabs, f"{filename}.wav"),
-                        "video": os.path.join(args.video_vocabs, f"{filename}.mp4")
-                    }
-                    for filename in batch_filenames
-                ]
-                inputs = model.prepare_input(inputs)
-                text, _ = model.generate(inputs)
-                texts.extend(text)
-                
-            answers = {filaname: t for filaname, t in zip(filenames, texts)}
-            agent_answers[retrieved_file] = answers
-
-        source["agent_answers"] = agent_answers
+    for source, answers in zip(sources, agent_answers):
+        source["agent_answers"] = answers
         targets.append(source)
     
-    with open(args.output, 'w') as f:
+    with open(args.output + ".tmp", 'w') as f:
         json.dump(targets, f, indent=2)
+    os.replace(args.output + ".tmp", args.output)
 
 
 
@@ -87,6 +187,12 @@ if __name__ == "__main__":
     args.add_argument("--audio_vocabs", type=str, default="./data/test/original-audio")
     args.add_argument("--output", type=str, default="./output/test_response.json")
     args.add_argument("--bsz", type=int, default=4)
+    args.add_argument("--journal", type=str, default=None, help="Append-only JSONL of answers, flushed every batch (default: output path with .jsonl).")
+    args.add_argument("--mm_cache_dir", type=str, default=None, help="Disk tier of the audio/video preprocessing cache.")
+    args.add_argument("--mm_cache_mem_gb", type=float, default=0.0, help="Memory tier of the preprocessing cache, e.g. 8 (default 0: off unless --mm_cache_dir is set).")
+    args.add_argument("--mm_cache_disk_gb", type=float, default=100.0, help="Size cap of the preprocessing cache on disk.")
+    args.add_argument("--prefix_cache", action="store_true", help="Prefill each segment once and reuse its KV cache for all questions about it.")
+    args.add_argument("--resume", action="store_true", help="Skip segments already answered in the journal.")
     args = args.parse_args()
 
     main(args)
\ No newline at end of file
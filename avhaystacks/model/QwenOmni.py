@@ -1,7 +1,9 @@
 # code base: https://github.com/QwenLM/Qwen2.5-Omni
+import os
 import json
 import torch
 from .base import BaseModel
+from .preprocess_cache import MMPreprocessCache
 from qwen_omni_utils import process_mm_info
 from transformers import Qwen2_5OmniForConditionalGeneration, Qwen2_5OmniProcessor
 
@@ -9,9 +11,13 @@ MODALITIES = {"text", "image", "video", "audio"}
 
 class Qwen2_5OMNI(BaseModel):
     
-    def __init__(self, model_name = "Qwen/Qwen2.5-Omni-7B", prompt = None, enable_flashattn = True, use_audio_in_video = True, return_audio = False):
+    def __init__(self, model_name = "Qwen/Qwen2.5-Omni-7B", prompt = None, enable_flashattn = True, use_audio_in_video = True, return_audio = False, preprocess_cache = None):
         
         self.prompt = prompt
+        # MMPreprocessCache (or its kwargs) reusing decoded audio/video across questions
+        if isinstance(preprocess_cache, dict):
+            preprocess_cache = MMPreprocessCache(settings = {"use_audio_in_video": use_audio_in_video}, **preprocess_cache)
+        self.preprocess_cache = preprocess_cache
         self.return_audio = return_audio
         self.use_audio_in_video = use_audio_in_video
 
@@ -30,7 +36,7 @@ class Qwen2_5OMNI(BaseModel):
         self.device = self.model.device
         self.dtype = self.model.dtype
 
-    def prepare_input(self, inputs):
+    def prepare_input(self, inputs, media_first = False):
         """
         Args:
             inputs: list of dict
@@ -42,34 +48,152 @@ class Qwen2_5OMNI(BaseModel):
                         text: str
                     }
                 ]
+            media_first: put the media before the question text, as generate_grouped does
         """
 
-        conversation = []
-        for input in inputs:
-            conversation.append([
-                {
-                    "role": "system",
-                    "content": "You are Qwen, a virtual human developed by the Qwen Team, Alibaba Group, capable of perceiving auditory and visual inputs, as well as generating text and speech.",
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": key, key: self.prompt.format(Question=value) if key == "text" and self.prompt is not None else value}
-                        for key, value in input.items() if key in MODALITIES
-                    ],
-                }
-            ])
+        conversation = [self._conversation(input, media_first) for input in inputs]
+
+        if self.preprocess_cache is not None:
+            audios, images, videos = self._cached_mm_info(conversation)
 
         if len(conversation) == 1:
             conversation = conversation[0]
 
         text = self.processor.apply_chat_template(conversation, add_generation_prompt=True, tokenize=False)
-        audios, images, videos = process_mm_info(conversation, use_audio_in_video=self.use_audio_in_video)
+        if self.preprocess_cache is None:
+            audios, images, videos = process_mm_info(conversation, use_audio_in_video=self.use_audio_in_video)
         inputs = self.processor(text=text, audio=audios, images=images, videos=videos, return_tensors="pt", padding=True, use_audio_in_video=self.use_audio_in_video)
         inputs = inputs.to(self.device).to(self.dtype)
 
         return inputs
 
+    def _conversation(self, input, media_first = False):
+        content = [
+            {"type": key, key: self.prompt.format(Question=value) if key == "text" and self.prompt is not None else value}
+            for key, value in input.items() if key in MODALITIES
+        ]
+        if media_first:
+            content.sort(key=lambda element: element["type"] == "text")
+        return [
+            {
+                "role": "system",
+                "content": "You are Qwen, a virtual human developed by the Qwen Team, Alibaba Group, capable of perceiving auditory and visual inputs, as well as generating text and speech.",
+            },
+            {
+                "role": "user",
+                "content": content,
+            }
+        ]
+
+    def _cached_mm_info(self, conversations):
+        """
+        process_mm_info over a batch of conversations, but each input's media
+        is processed once and then served from `preprocess_cache`; only the
+        text is rebuilt per question.
+        """
+        def process(media):
+            outputs = process_mm_info([{"role": "user", "content": media}], use_audio_in_video=self.use_audio_in_video)
+            return tuple(output or [] for output in outputs)
+
+        audios, images, videos = [], [], []
+        for conversation in conversations:
+            media = [element for element in conversation[-1]["content"] if element["type"] != "text"]
+            if media:
+                a, i, v = self.preprocess_cache.get(media, process)
+                audios.extend(a)
+                images.extend(i)
+                videos.extend(v)
+        # process_mm_info returns None for a modality with no inputs
+        return audios or None, images or None, videos or None
+
+    @torch.no_grad()
+    def generate_grouped(self, inputs, max_new_tokens = 1024):
+        """
+        Text-only generation for many questions over few segments. Inputs
+        sharing the same media are grouped; the media (placed before the
+        question in the prompt) is prefilled once into a KV cache, which is
+        expanded along the batch dimension so all the group's questions decode
+        together, each only prefilling its own suffix. Inputs whose media is
+        not shared are generated together in one regular batch (with the same
+        media-first prompt).
+        Args:
+            inputs: list of dict, as in prepare_input
+        Returns:
+            List: answers in input order
+        """
+        groups = {}
+        for idx, input in enumerate(inputs):
+            media = tuple((key, value) for key, value in input.items() if key in MODALITIES and key != "text")
+            groups.setdefault(media, []).append(idx)
+
+        answers = [None] * len(inputs)
+        singles = []
+        for media, indices in groups.items():
+            if len(indices) == 1 or not media or not self._generate_shared_prefix(inputs, media, indices, answers, max_new_tokens):
+                singles.extend(indices)
+
+        if singles:
+            outputs, _ = self.generate(self.prepare_input([inputs[idx] for idx in singles], media_first=True))
+            for idx, output in zip(singles, outputs):
+                answers[idx] = output
+        return answers
+
+    def _generate_shared_prefix(self, inputs, media, indices, answers, max_new_tokens):
+        """Answer `indices` (same `media`) from one prefix prefill; False if no prefix is shared."""
+        thinker = self.model.thinker
+        conversations = [self._conversation(inputs[idx], media_first=True) for idx in indices]
+        texts = [self.processor.apply_chat_template(conversation, add_generation_prompt=True, tokenize=False) for conversation in conversations]
+
+        # the media-only turn, minus its closing tag, is a prefix of every question's prompt
+        media_conversation = self._conversation(dict(media), media_first=True)
+        prefix = self.processor.apply_chat_template(media_conversation, add_generation_prompt=False, tokenize=False)
+        prefix = prefix[:prefix.rindex("<|im_end|>")]
+        if not all(text.startswith(prefix) for text in texts):
+            return False
+
+        # the prompt template before the question is shared too; cut after a newline,
+        # where the tokenizer always starts a new token
+        common = os.path.commonprefix([text[len(prefix):text.rindex("<|im_end|>")] for text in texts])
+        cut = common.rfind("\n") + 1
+        if cut and not any(text[len(prefix) + cut].isspace() for text in texts):
+            prefix += common[:cut]
+
+        if self.preprocess_cache is not None:
+            audios, images, videos = self._cached_mm_info([media_conversation])
+        else:
+            audios, images, videos = process_mm_info(media_conversation, use_audio_in_video=self.use_audio_in_video)
+        prefix_inputs = self.processor(text=prefix, audio=audios, images=images, videos=videos, return_tensors="pt", padding=True, use_audio_in_video=self.use_audio_in_video)
+        prefix_inputs = prefix_inputs.to(self.device).to(self.dtype)
+
+        # one-token generate = prefill of the prefix; the cache then holds exactly the prefix
+        prefill = thinker.generate(**prefix_inputs, use_audio_in_video=self.use_audio_in_video, max_new_tokens=1, return_dict_in_generate=True)
+        cache, rope_deltas = prefill.past_key_values, thinker.rope_deltas
+
+        # suffixes are left-padded to one length; the pads are masked and each row's
+        # rope offset is shifted back by its pad count so real positions stay contiguous
+        tokenizer = self.processor.tokenizer
+        suffixes = [tokenizer(text[len(prefix):], add_special_tokens=False).input_ids for text in texts]
+        length = max(len(ids) for ids in suffixes)
+        pads = torch.tensor([length - len(ids) for ids in suffixes], device=self.device)
+        suffix_ids = torch.tensor([[tokenizer.pad_token_id] * (length - len(ids)) + ids for ids in suffixes], device=self.device)
+        prefix_ids = prefix_inputs["input_ids"].expand(len(indices), -1)
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), (torch.arange(length, device=self.device) >= pads[:, None]).long()], dim=1)
+
+        cache.batch_repeat_interleave(len(indices))
+        thinker.rope_deltas = rope_deltas.expand(len(indices), -1) - pads[:, None].to(rope_deltas.dtype)
+        text_ids = thinker.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=cache,
+            use_audio_in_video=self.use_audio_in_video,
+            max_new_tokens=max_new_tokens,
+        )
+        outputs = self.processor.batch_decode(text_ids[:, input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        for idx, output in zip(indices, outputs):
+            answers[idx] = output.strip()
+        return True
+
     @torch.no_grad()
     def generate(self, inputs):
         
@@ -2,31 +2,101 @@
 # sys.path.append("/ibex/user/feij0a/phd_project/av-haystack/ImageBind")
 import os
 import math
+import time
 import torch
 import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from imagebind import data
 from imagebind.models import imagebind_model
 from imagebind.models.imagebind_model import ModalityType
+try:
+    from .embedding_index import EmbeddingIndex, QueryEmbeddingCache, ShardedEmbeddingStore
+    from .search import build_index
+except ImportError:  # run as a script: python model/avrag.py
+    from embedding_index import EmbeddingIndex, QueryEmbeddingCache, ShardedEmbeddingStore
+    from search import build_index
 # from ImageBind.imagebind import data
 # from ImageBind.imagebind.models import imagebind_model
 # from ImageBind.imagebind.models.imagebind_model import ModalityType
 
 
+_WORKER_RAG = None
+
+# where imagebind_huge(pretrained=True) downloads its checkpoint
+PRETRAINED_URL = "https://dl.fbaipublicfiles.com/imagebind/imagebind_huge.pth"
+PRETRAINED_PATH = os.path.join(".checkpoints", "imagebind_huge.pth")
+
+
+def _init_embed_worker(model_path, bsz, fp16_storage, num_threads):
+    """Load one CPU model replica per worker process, with capped torch threads."""
+    global _WORKER_RAG
+    torch.set_num_threads(num_threads)
+    _WORKER_RAG = AVRAG(model_path = model_path, bsz = bsz, fp16_storage = fp16_storage, device = "cpu")
+
+
+def _embed_chunk(start, paths, data_type):
+    return start, _WORKER_RAG.embed(paths, data_type)
+
+
+# joint_rag fusion modes -> per-modality score normalization
+FUSION_MODES = {'2': "zscore", '3': "rrf"}
+
+
+def normalize_scores(scores, method = "zscore", rrf_k = 60):
+    """
+    Normalize stacked per-modality scores (M, n, m) along the vocabulary axis
+    so they can be blended: "zscore" standardizes each row, "rrf" replaces
+    scores by 1 / (rrf_k + rank) with ties ranked by vocab index.
+    """
+    if method == "zscore":
+        return (scores - scores.mean(-1, keepdim = True)) / scores.std(-1, keepdim = True).clamp_min(1e-12)
+    if method == "rrf":
+        order = torch.sort(scores, dim = -1, descending = True, stable = True).indices
+        ranks = torch.empty_like(order)
+        ranks.scatter_(-1, order, torch.arange(1, scores.shape[-1] + 1).expand_as(order))
+        return 1.0 / (rrf_k + ranks.to(scores.dtype))
+    raise NotImplementedError(f"Unknown score normalization: {method}")
+
+
+def ranked_topk(scores, k):
+    """Top-k indices per row, ties broken by the lower index (unlike torch.topk)."""
+    return torch.sort(scores, dim = -1, descending = True, stable = True).indices[:, :k]
+
+
+def union_ranked(*ranked_lists):
+    """Interleave ranked lists rank by rank and drop repeats, keeping first occurrences."""
+    merged = [item for items in zip(*ranked_lists) for item in items]
+    return list(dict.fromkeys(merged))
+
+
+def segment_parent(filename):
+    """Source video of a clipping.py segment named '{video}__{index}'."""
+    return filename.rsplit("__", 1)[0]
+
+
 class AVRAG:
     
-    def __init__(self, model_path = None, bsz = 128):
+    def __init__(self, model_path = None, bsz = 128, index_backend = "exact", index_kwargs = None, num_workers = 0, queue_depth = 2, fp16_storage = False, embed_procs = 0, device = None, query_cache_dir = None, query_cache_size = 20000):
         
         self.bsz = bsz
-        self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.model_path = model_path
+        self.embed_procs = embed_procs  # > 1 -> media embedded by that many CPU model replicas
+        self.storage_dtype = torch.float16 if fp16_storage else torch.float32  # vocab embeddings only
+        self.num_workers = num_workers  # 0 -> load batches on the main thread
+        self.queue_depth = queue_depth  # batches loaded ahead of the model
+        self.last_timings = {}
+        self.index_backend = index_backend
+        self.index_kwargs = index_kwargs or {}
+        self.query_cache = None  # persistent text-embedding cache, see QueryEmbeddingCache
+        if query_cache_dir is not None:
+            self.query_cache = QueryEmbeddingCache(query_cache_dir, QueryEmbeddingCache.checkpoint_id(model_path), max_entries = query_cache_size)
+        self.device = device or ("cuda:0" if torch.cuda.is_available() else "cpu")
 
-        # Instantiate model
-        if model_path:
-            self.model = imagebind_model.imagebind_huge(pretrained = False)
-            self.model.load_state_dict(torch.load(model_path))
-        else: # download pretrained model automatically
-            self.model = imagebind_model.imagebind_huge(pretrained = True)
-        self.model.eval()
-        self.model.to(self.device)
+        # Instantiate model on first use, so sharded embedding (embed_procs > 1)
+        # never holds a parent replica next to the workers' ones
+        self._model = None
 
         self.load_and_transform_func = {
             ModalityType.TEXT: data.load_and_transform_text,
@@ -34,12 +104,28 @@ class AVRAG:
             ModalityType.VISION: [data.load_and_transform_vision_data, data.load_and_transform_video_data]
         }
 
+    @property
+    def model(self):
+        if self._model is None:
+            if self.model_path:
+                model = imagebind_model.imagebind_huge(pretrained = False)
+                model.load_state_dict(torch.load(self.model_path))
+            else: # download pretrained model automatically
+                model = imagebind_model.imagebind_huge(pretrained = True)
+            model.eval()
+            self._model = model.to(self.device)
+        return self._model
+
     @torch.no_grad()
-    def encode(self, input_paths, data_type, cache = False) -> dict:
+    def encode(self, input_paths, data_type, cache = False, index_dir = None, stream_dir = None) -> dict:
         """
         Args:
             input_paths (str or list): Paths to the input data.
             cache (bool): If True, loads the embeddings from a cache file.
+            index_dir (str): If set, keeps a persistent EmbeddingIndex there and
+                only embeds new or changed files.
+            stream_dir (str): If set, streams embeddings to a resumable sharded
+                store there instead of holding them in memory.
         Returns:
             Dict: {
                 filename: list,
@@ -58,30 +144,24 @@ class AVRAG:
             else:
                 input_paths = [input_paths]
 
-        embeddings = None
-        epochs = len(input_paths) // self.bsz - 1 if len(input_paths) % self.bsz == 0 else len(input_paths) // self.bsz
-
-        for i in range(epochs + 1):
-            start = i * self.bsz
-            end = (i + 1) * self.bsz
-            input_batch = input_paths[start:end]
-
+        if index_dir is not None and data_type != ModalityType.TEXT:
+            name = data_type
             if data_type == ModalityType.VISION:
-                indice = 1 if input_paths[0].endswith(".mp4") else 0
-                inputs = {
-                    data_type: self.load_and_transform_func[data_type][indice](input_batch, self.device),
-                }
-            else:
-                inputs = {
-                    data_type: self.load_and_transform_func[data_type](input_batch, self.device),
-                }
-            
-            embedding_batch = self.model(inputs)[data_type].cpu()
+                name = "video" if input_paths[0].endswith(".mp4") else "image"
+            index = EmbeddingIndex(index_dir, name, dtype = "float16" if self.storage_dtype == torch.float16 else "float32")
+            embeddings = index.update(input_paths, lambda paths: self.embed(paths, data_type))
+            print("{} index: {}".format(name, embeddings.pop("stats")))
+            return embeddings
 
-            if embeddings is None:
-                embeddings = embedding_batch
-            else:
-                embeddings = torch.cat((embeddings, embedding_batch), dim = 0)
+        if stream_dir is not None and data_type != ModalityType.TEXT:
+            return self.encode_to_disk(input_paths, data_type, stream_dir)
+
+        if data_type == ModalityType.TEXT and self.query_cache is not None:
+            embeddings = self.query_cache.embed(input_paths, lambda texts: self.embed(texts, data_type))
+            print("query cache: {}".format(self.query_cache.stats))
+        else:
+            embeddings = self.embed(input_paths, data_type)
+        indice = 1 if input_paths[0].endswith(".mp4") else 0
 
         if data_type != ModalityType.TEXT:
             filenames = ['.'.join(os.path.basename(path).split('.')[:-1]) for path in input_paths]
@@ -99,18 +179,175 @@ class AVRAG:
             torch.save(embeddings, os.path.join(os.path.dirname(os.path.dirname(input_paths[0])), f"{data_type}_embeddings.pt"))
 
         return embeddings
+
+    @torch.no_grad()
+    def encode_to_disk(self, input_paths, data_type, stream_dir, shard_size = None) -> dict:
+        """
+        Embed `input_paths` shard by shard (`shard_size` rows, default 16
+        batches) into a ShardedEmbeddingStore, resuming after the last
+        complete shard if an earlier run over the same inputs was interrupted.
+        Returns:
+            Dict: {
+                filename: list,
+                embeddings: torch.Tensor over the memory-mapped matrix,
+            }
+        """
+        name = data_type
+        if data_type == ModalityType.VISION:
+            name = "video" if input_paths[0].endswith(".mp4") else "image"
+        store = ShardedEmbeddingStore(
+            stream_dir, name, input_paths,
+            dtype = "float16" if self.storage_dtype == torch.float16 else "float32",
+            checkpoint = QueryEmbeddingCache.checkpoint_id(self.model_path),
+        )
+        shard_size = shard_size or self.bsz * 16
+
+        if store.resume_from:
+            print("{}: resuming at row {} of {}".format(name, store.resume_from, len(input_paths)))
+        for start in range(store.resume_from, len(input_paths), shard_size):
+            store.append(self.embed(input_paths[start:start + shard_size], data_type))
+
+        return {
+            "filename": [EmbeddingIndex.filename(path) for path in input_paths],
+            "embeddings": torch.from_numpy(store.finalize()),
+        }
+
+    @torch.no_grad()
+    def embed(self, input_paths, data_type, out = None):
+        """
+        Args:
+            input_paths (list): Paths (or texts) to embed.
+            out (torch.Tensor, (n, d)): Optional preallocated buffer (e.g. a
+                tensor over a memory-mapped file) to write the rows into.
+        Returns:
+            torch.Tensor (n, d): Embeddings in input order, stored as
+            `storage_dtype` for media and float32 for text.
+        With `num_workers` > 0, media batches are loaded and transformed on a
+        worker pool (processes for video, threads for audio) up to
+        `queue_depth` batches ahead while the model embeds the current one.
+        With `embed_procs` > 1, media is embedded by `embed_sharded` instead.
+        """
+        if self.embed_procs > 1 and data_type != ModalityType.TEXT:
+            return self.embed_sharded(input_paths, data_type, out = out)
+
+        if data_type == ModalityType.VISION:
+            indice = 1 if input_paths[0].endswith(".mp4") else 0
+            load_func = self.load_and_transform_func[data_type][indice]
+        else:
+            load_func = self.load_and_transform_func[data_type]
+
+        batches = [input_paths[start:start + self.bsz] for start in range(0, len(input_paths), self.bsz)]
+        dtype = torch.float32 if data_type == ModalityType.TEXT else self.storage_dtype
+
+        embeddings = out
+        start = 0
+        decode_time, model_time = 0.0, 0.0
+        for inputs_batch, waited in self._load_batches(load_func, batches, data_type):
+            decode_time += waited
+
+            t0 = time.time()
+            inputs = {
+                data_type: inputs_batch.to(self.device),
+            }
+            embedding_batch = self.model(inputs)[data_type].cpu()
+            model_time += time.time() - t0
+
+            # the output is allocated once, as soon as the embedding size is known
+            if embeddings is None:
+                embeddings = torch.empty((len(input_paths), embedding_batch.shape[1]), dtype = dtype)
+            embeddings[start:start + len(embedding_batch)] = embedding_batch
+            start += len(embedding_batch)
+
+        self.last_timings = {"decode": decode_time, "model": model_time}
+        if data_type != ModalityType.TEXT:
+            print("{} embedding: decode {:.2f}s (blocking), model {:.2f}s".format(data_type, decode_time, model_time))
+        return embeddings
+
+    def embed_sharded(self, input_paths, data_type, out = None, num_procs = None, num_threads = None, chunk_size = None):
+        """
+        Embed media with `num_procs` (default `embed_procs`) spawned worker
+        processes, each holding its own CPU model replica limited to
+        `num_threads` torch threads (default: cores / processes). Work is
+        handed out in `chunk_size` slices (default 4 batches) so faster workers
+        pick up more, and every slice is written back at its own offset, so
+        the result is in input order regardless of completion order. A parent
+        replica that is already loaded is released first, so memory holds
+        `num_procs` replicas; it is reloaded if text needs embedding later.
+        Returns:
+            torch.Tensor (n, d): Embeddings stored as `storage_dtype`.
+        """
+        self._model = None
+        num_procs = num_procs or self.embed_procs
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_procs)
+        chunk_size = chunk_size or self.bsz * 4
+        starts = range(0, len(input_paths), chunk_size)
+
+        t0 = time.time()
+        embeddings = out
+        ctx = multiprocessing.get_context("spawn")
+        # download the pretrained checkpoint once here rather than in every worker
+        model_path = self.model_path
+        if not model_path:
+            model_path = PRETRAINED_PATH
+            if not os.path.exists(model_path):
+                os.makedirs(os.path.dirname(model_path), exist_ok = True)
+                torch.hub.download_url_to_file(PRETRAINED_URL, model_path, progress = True)
+        with ProcessPoolExecutor(num_procs, mp_context = ctx, initializer = _init_embed_worker,
+                                 initargs = (model_path, self.bsz, self.storage_dtype == torch.float16, num_threads)) as pool:
+            futures = [pool.submit(_embed_chunk, start, input_paths[start:start + chunk_size], data_type) for start in starts]
+            for future in futures:
+                start, embedding_chunk = future.result()
+                if embeddings is None:
+                    embeddings = torch.empty((len(input_paths), embedding_chunk.shape[1]), dtype = self.storage_dtype)
+                embeddings[start:start + len(embedding_chunk)] = embedding_chunk
+
+        self.last_timings = {"total": time.time() - t0}
+        print("{} embedding: {} processes x {} threads, {:.2f}s".format(data_type, num_procs, num_threads, self.last_timings["total"]))
+        return embeddings
+
+    def _load_batches(self, load_func, batches, data_type):
+        """Yield (transformed batch, seconds the caller waited for it) in order."""
+        if self.num_workers <= 0 or data_type == ModalityType.TEXT:
+            for batch in batches:
+                t0 = time.time()
+                inputs = load_func(batch, self.device)
+                yield inputs, time.time() - t0
+            return
+
+        if data_type == ModalityType.VISION:
+            pool = ProcessPoolExecutor(self.num_workers, mp_context = multiprocessing.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(self.num_workers)
+
+        with pool:
+            pending = deque(pool.submit(load_func, batch, "cpu") for batch in batches[:self.queue_depth])
+            submitted = len(pending)
+            while pending:
+                t0 = time.time()
+                inputs = pending.popleft().result()
+                waited = time.time() - t0
+                if submitted < len(batches):
+                    pending.append(pool.submit(load_func, batches[submitted], "cpu"))
+                    submitted += 1
+                yield inputs, waited
     
-    def topk(self, queries, vocabs, k = 1):
+    def build_vocab_index(self, vocabs):
+        return build_index(vocabs, self.index_backend, **self.index_kwargs)
+
+    def topk(self, queries, vocabs, k = 1, index = None):
         """
         Args:
             queries (torch.Tensor, (n, d)): Query embeddings.
             vocabs (torch.Tensor, (m, d)): Vocabulary embeddings.
             k (int): Number of top results to return.
+            index: Index over `vocabs` from `build_vocab_index`, to reuse it across calls.
         Returns:
             List (n, k): Top k results.
         """
-        scores = torch.softmax(queries @ vocabs.T, dim = -1)
-        topk_indices = torch.topk(scores, k = k, dim = -1).indices
+        # softmax is monotonic, so ranking the raw inner products is enough
+        if index is None:
+            index = self.build_vocab_index(vocabs)
+        topk_indices = index.search(queries, k = k)
 
         return topk_indices
 
@@ -128,12 +365,14 @@ class AVRAG:
 
         return topk_files
     
-    def joint_rag(self, query = None, vocab_vision = None, vocab_audio = None, k = 1, alpha_v = 0.5, mode = '0'):
+    def joint_rag(self, query = None, vocab_vision = None, vocab_audio = None, k = 1, alpha_v = 0.5, mode = '0', rrf_k = 60):
         """
         Args:
             mode (str):
             0 -> text as query, return topk filename via joint embedding
             1 -> text as query, return both topk vision and topk audios
+            2 -> text as query, return topk filename via z-score normalized vision/audio score fusion
+            3 -> text as query, return topk filename via reciprocal rank fusion (weights alpha_v, 1 - alpha_v)
         """
         if mode == '0':
 
@@ -160,15 +399,185 @@ class AVRAG:
                 # )
                 topk_files.append(
                     {
-                        query["filename"][indice]: list(set([vocab_vision["filename"][i] for i in topi_indices_vision] + [vocab_audio["filename"][i] for i in topi_indices_audio]))
+                        query["filename"][indice]: union_ranked([vocab_vision["filename"][i] for i in topi_indices_vision], [vocab_audio["filename"][i] for i in topi_indices_audio])
                     }
                 )
 
+        elif mode in FUSION_MODES:
+            return self.joint_rag_sweep(query, vocab_vision, vocab_audio, k = k, alphas = (alpha_v,), modes = (mode,), rrf_k = rrf_k)[f"mode{mode}_alpha{alpha_v}"]
+
         else:
-            raise NotImplementedError("Only mode 0 is implemented.")
+            raise NotImplementedError("Only modes 0, 1, 2 and 3 are implemented.")
         
         return topk_files
 
+    def joint_rag_sweep(self, query = None, vocab_vision = None, vocab_audio = None, k = 1, alphas = (0.5,), modes = ('0',), rrf_k = 60, query_block = 256):
+        """
+        Run joint_rag for every (mode, alpha_v) setting in one pass. The
+        query-vision and query-audio score matrices are computed once per
+        block of `query_block` queries (and normalized once for the fusion
+        modes), and every blend is derived from them as
+        alpha_v * S_v + (1 - alpha_v) * S_a (scores are linear in alpha_v).
+        Scoring is exact, whatever `index_backend` is.
+        Returns:
+            Dict: {"mode{mode}_alpha{alpha_v}" / "mode1": joint_rag-style results}
+        """
+        vision = torch.as_tensor(vocab_vision["embeddings"])
+        audio = torch.as_tensor(vocab_audio["embeddings"])
+        k = min(k, len(vision))
+        if set(modes) - {'0', '1'} - set(FUSION_MODES):
+            raise NotImplementedError("Only modes 0, 1, 2 and 3 can be swept.")
+        settings = {}
+        for mode in modes:
+            if mode == '1':
+                settings["mode1"] = ('1', None)
+            else:
+                settings.update({f"mode{mode}_alpha{alpha_v}": (mode, alpha_v) for alpha_v in alphas})
+
+        indices = {name: [] for name in settings}
+        indices_audio = []
+        for start in range(0, len(query["embeddings"]), query_block):
+            queries = torch.as_tensor(query["embeddings"][start:start + query_block]).float()
+            scores = torch.stack((queries @ vision.float().T, queries @ audio.float().T))
+            normalized = {mode: normalize_scores(scores, FUSION_MODES[mode], rrf_k = rrf_k) for mode in modes if mode in FUSION_MODES}
+            for name, (mode, alpha_v) in settings.items():
+                if mode == '1':
+                    indices[name].append(ranked_topk(scores[0], k))
+                    indices_audio.append(ranked_topk(scores[1], k))
+                else:
+                    blend = normalized.get(mode, scores)
+                    indices[name].append(ranked_topk(alpha_v * blend[0] + (1 - alpha_v) * blend[1], k))
+
+        results = {}
+        for name, (mode, _) in settings.items():
+            topk_indices = torch.cat(indices[name]).tolist()
+            if mode != '1':
+                results[name] = [
+                    {query["filename"][indice]: [vocab_vision["filename"][i] for i in topi_indices]}
+                    for indice, topi_indices in enumerate(topk_indices)
+                ]
+            else:
+                results[name] = [
+                    {query["filename"][indice]: union_ranked([vocab_vision["filename"][i] for i in topi_indices_vision], [vocab_audio["filename"][i] for i in topi_indices_audio])}
+                    for indice, (topi_indices_vision, topi_indices_audio) in enumerate(zip(topk_indices, torch.cat(indices_audio).tolist()))
+                ]
+
+        return results
+
+    def segment_rag(self, query = None, vocab_vision = None, vocab_audio = None, k = 1, segments_per_video = 2, alpha_v = 0.5):
+        """
+        Segment-level retrieval over the clips written by clipping.py
+        (filenames '{video}__{index}'), scored with the mode-0 joint embedding.
+        Returns:
+            List: [{query: {video: [segment, ...]}}] with the k videos whose
+            best segments rank highest, each with up to `segments_per_video`
+            of its best segments in score order.
+        The ranking is read in a window that doubles, for the queries that
+        still need it, until k videos with all their wanted segments are found
+        (or the whole vocabulary is ranked), so long videos with many strong
+        clips cannot crowd the others out.
+        """
+        embeddings = alpha_v * vocab_vision["embeddings"] + (1 - alpha_v) * vocab_audio["embeddings"]
+        segment_counts = {}
+        for name in vocab_vision["filename"]:
+            segment_counts[segment_parent(name)] = segment_counts.get(segment_parent(name), 0) + 1
+
+        grouped = [None] * len(query["filename"])
+        pending = list(range(len(grouped)))
+        depth = min(len(embeddings), k * segments_per_video * 4)
+        index = self.build_vocab_index(embeddings)
+        while pending:
+            topk_indices = self.topk(query["embeddings"][pending], embeddings, k = depth, index = index)
+            still_pending = []
+            for indice, topi_indices in zip(pending, topk_indices):
+                videos = self._group_segments([vocab_vision["filename"][i] for i in topi_indices], k, segments_per_video)
+                complete = len(videos) == min(k, len(segment_counts)) and all(
+                    len(segments) == min(segments_per_video, segment_counts[video]) for video, segments in videos.items()
+                )
+                if complete or depth == len(embeddings):
+                    grouped[indice] = videos
+                else:
+                    still_pending.append(indice)
+            pending = still_pending
+            depth = min(len(embeddings), depth * 2)
+
+        return [{name: videos} for name, videos in zip(query["filename"], grouped)]
+
+    def hierarchical_rag(self, query = None, vocab_vision = None, vocab_audio = None, k = 1, shortlist = 10, segments_per_video = 2, alpha_v = 0.5):
+        """
+        Two-stage coarse-to-fine retrieval over clipping.py segments.
+        Stage one ranks videos by their pooled (mean) joint segment embedding
+        and keeps the top `shortlist`; stage two scores only the segments of
+        those videos. Every segment of the shortlisted videos is scored and
+        grouped by video, so `shortlist` alone sets the stage-two depth.
+        Output matches `segment_rag`.
+        """
+        embeddings = alpha_v * vocab_vision["embeddings"] + (1 - alpha_v) * vocab_audio["embeddings"]
+        parents = [segment_parent(name) for name in vocab_vision["filename"]]
+        videos = list(dict.fromkeys(parents))
+        video_rows = {video: i for i, video in enumerate(videos)}
+        owner = torch.tensor([video_rows[p] for p in parents])
+
+        # stage one: pooled video embeddings
+        pooled = torch.zeros(len(videos), embeddings.shape[1], dtype = embeddings.dtype).index_add_(0, owner, embeddings)
+        pooled = pooled / torch.bincount(owner, minlength = len(videos)).unsqueeze(1).to(pooled.dtype)
+        shortlist_indices = self.topk(query["embeddings"], pooled, k = min(shortlist, len(videos)))
+
+        # stage two: segments of the shortlisted videos only
+        segment_rows = [[] for _ in videos]
+        for row, video in enumerate(owner.tolist()):
+            segment_rows[video].append(row)
+
+        topk_segments = []
+        for indice, topi_videos in enumerate(shortlist_indices):
+            rows = torch.tensor([row for v in topi_videos.tolist() for row in segment_rows[v]])
+            scores = embeddings[rows].float() @ query["embeddings"][indice].float()
+            order = ranked_topk(scores.unsqueeze(0), len(rows))[0]
+            ranked = [vocab_vision["filename"][i] for i in rows[order].tolist()]
+            topk_segments.append({query["filename"][indice]: self._group_segments(ranked, k, segments_per_video)})
+
+        return topk_segments
+
+    @staticmethod
+    def _group_segments(ranked, k, segments_per_video):
+        """Group ranked segment names by video: first k videos, their best segments."""
+        videos = {}
+        for segment in ranked:
+            video = segment_parent(segment)
+            if video not in videos:
+                if len(videos) == k:
+                    continue
+                videos[video] = []
+            if len(videos[video]) < segments_per_video:
+                videos[video].append(segment)
+        return videos
+
+def benchmark_output_buffer(num_items = 10000, dim = 1024, bsz = 128):
+    """
+    Time collecting `num_items` embeddings batch by batch with the old
+    torch.cat growth against writing into a preallocated buffer.
+    """
+    batches = [torch.randn(min(bsz, num_items - start), dim) for start in range(0, num_items, bsz)]
+
+    t0 = time.time()
+    grown = None
+    for batch in batches:
+        grown = batch if grown is None else torch.cat((grown, batch), dim = 0)
+    t_cat = time.time() - t0
+
+    results = {"cat_s": t_cat}
+    for dtype in (torch.float32, torch.float16):
+        t0 = time.time()
+        out = torch.empty((num_items, dim), dtype = dtype)
+        start = 0
+        for batch in batches:
+            out[start:start + len(batch)] = batch
+            start += len(batch)
+        results[f"prealloc_{str(dtype).split('.')[-1]}_s"] = time.time() - t0
+        results[f"prealloc_{str(dtype).split('.')[-1]}_mb"] = out.numel() * out.element_size() / 2 ** 20
+    return results
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="AV-RAG")
@@ -178,8 +587,13 @@ if __name__ == "__main__":
     parser.add_argument("--mode", type=str, default="0", help="Mode.")
     parser.add_argument("--topk", type=int, default=1, help="Number of top results to return.")
     parser.add_argument("--alpha_v", type=float, default=0.5, help="The importance of vision compared to audio.")
+    parser.add_argument("--bench_buffer", type=int, default=0, help="Only benchmark output buffering for this many items.")
     args = parser.parse_args()
 
+    if args.bench_buffer:
+        print(benchmark_output_buffer(num_items = args.bench_buffer, bsz = args.bsz))
+        raise SystemExit
+
     rag = AVRAG(model_path = args.model_path, bsz = args.bsz)
 
     text_list=["A dog", "A car", "A bird"]
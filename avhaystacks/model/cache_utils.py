@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+
+
+def content_hash(path, block = 2 ** 20):
+    """File identity by content: sha1 over the size and the first and last `block` bytes."""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            h.update(f.read(block))
+    return h.hexdigest()
+
+
+def stat_id(path):
+    """Cheap file identity: absolute path, size and mtime (ns)."""
+    stat = os.stat(path)
+    return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@contextmanager
+def atomic_write(path, suffix = ""):
+    """
+    Yield a temporary path to write to; it replaces `path` only once the
+    block finishes. `suffix` is appended to the temporary name for writers
+    that add an extension themselves (np.save and ".npy").
+    """
+    tmp = path + ".tmp" + suffix
+    yield tmp
+    os.replace(tmp, path)
+
+
+def read_json(path, default = None):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json(path, obj):
+    with atomic_write(path) as tmp:
+        with open(tmp, "w") as f:
+            json.dump(obj, f)
+
+
+class LRUManifest:
+    """
+    Manifest of cache entries, {key: {"bytes", "atime", ...}}, persisted as
+    JSON at `path` (in memory only when `path` is None), with
+    least-recently-used eviction and the cache's hits / misses / evictions
+    counters in `stats`.
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+        self.entries = read_json(path, {}) if path is not None else {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def touch(self, key, nbytes = 0, **fields):
+        """Mark `key` as just used, adding `nbytes` and setting extra `fields`."""
+        entry = self.entries.setdefault(key, {"bytes": 0, "atime": 0.0})
+        entry["bytes"] += nbytes
+        entry["atime"] = time.time()
+        entry.update(fields)
+        return entry
+
+    def pop(self, key):
+        return self.entries.pop(key)
+
+    def evict(self, max_bytes = None, max_entries = None, keep = ()):
+        """
+        Drop least recently used entries, never those in `keep`, until the
+        total bytes and the entry count are within the limits.
+        Returns:
+            List: the dropped keys, for the caller to delete their data.
+        """
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        dropped = []
+        for key in sorted(self.entries, key = lambda k: self.entries[k]["atime"]):
+            over_bytes = max_bytes is not None and total > max_bytes
+            over_entries = max_entries is not None and len(self.entries) > max_entries
+            if not (over_bytes or over_entries):
+                break
+            if key in keep:
+                continue
+            total -= self.entries.pop(key)["bytes"]
+            dropped.append(key)
+        self.stats["evictions"] += len(dropped)
+        return dropped
+
+    def save(self):
+        if self.path is not None:
+            write_json(self.path, self.entries)
@@ -0,0 +1,253 @@
+import os
+import hashlib
+import numpy as np
+import torch
+try:
+    from .cache_utils import LRUManifest, atomic_write, content_hash, read_json, stat_id, write_json
+except ImportError:  # run as a script: python model/avrag.py
+    from cache_utils import LRUManifest, atomic_write, content_hash, read_json, stat_id, write_json
+
+
+class EmbeddingIndex:
+    """
+    Persistent, incremental embedding index for a vocabulary of media files.
+
+    Rows live in `{name}.npy` (`dtype`, memory-mapped on load) and the
+    manifest `{name}.json` records, per row, the file path, its `stat_id`
+    and `content_hash`. `update` only embeds files that are new or whose content
+    changed, and drops rows of files that are no longer in the vocabulary.
+    """
+
+    def __init__(self, root, name, dtype = "float32"):
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.name = name
+        self.matrix_path = os.path.join(root, f"{name}.npy")
+        self.manifest_path = os.path.join(root, f"{name}.json")
+
+    @staticmethod
+    def filename(path):
+        return '.'.join(os.path.basename(path).split('.')[:-1])
+
+    def load(self):
+        """
+        Returns:
+            (entries, matrix): manifest rows and the memory-mapped (n, d)
+            matrix, or ([], None) when the index does not exist yet.
+        """
+        if not (os.path.exists(self.manifest_path) and os.path.exists(self.matrix_path)):
+            return [], None
+        entries = read_json(self.manifest_path)["entries"]
+        # copy-on-write mapping: lazily paged in, writable for torch, never flushed
+        return entries, np.load(self.matrix_path, mmap_mode = "c")
+
+    def update(self, input_paths, embed_fn):
+        """
+        Args:
+            input_paths (list): Current vocabulary; row order follows it.
+            embed_fn (callable): list of paths -> torch.Tensor (n, d).
+        Returns:
+            Dict: {
+                filename: list,
+                embeddings: torch.Tensor (backed by the memory-mapped file),
+                stats: {kept, embedded, dropped},
+            }
+        """
+        if not input_paths:
+            raise ValueError("Cannot index an empty vocabulary.")
+
+        entries, matrix = self.load()
+        known = {entry["path"]: (row, entry) for row, entry in enumerate(entries)}
+
+        new_entries, sources, to_embed = [], [], []
+        for path in input_paths:
+            entry = {"path": path, "stat": stat_id(path)}
+            row, old = known.get(path, (None, None))
+            if old is not None and old.get("stat") == entry["stat"]:
+                entry["hash"] = old["hash"]
+            else:
+                entry["hash"] = content_hash(path)
+                if old is not None and old["hash"] != entry["hash"]:
+                    row = None
+
+            if row is None:
+                sources.append(("new", len(to_embed)))
+                to_embed.append(path)
+            else:
+                sources.append(("old", row))
+            new_entries.append(entry)
+
+        fresh = embed_fn(to_embed).float().cpu().numpy().astype(self.dtype) if to_embed else None
+        dim = fresh.shape[1] if fresh is not None else matrix.shape[1]
+        stats = {
+            "kept": len(input_paths) - len(to_embed),
+            "embedded": len(to_embed),
+            "dropped": len(set(known) - set(input_paths)),
+        }
+
+        if to_embed or stats["dropped"] or matrix.dtype != self.dtype or [e["path"] for e in entries] != list(input_paths):
+            os.makedirs(self.root, exist_ok = True)
+            out = np.empty((len(input_paths), dim), dtype = self.dtype)
+            for i, (kind, row) in enumerate(sources):
+                out[i] = fresh[row] if kind == "new" else matrix[row]
+            del matrix
+
+            with atomic_write(self.matrix_path, ".npy") as tmp:
+                np.save(tmp, out)
+
+        write_json(self.manifest_path, {"entries": new_entries})
+
+        _, matrix = self.load()
+        return {
+            "filename": [self.filename(entry["path"]) for entry in new_entries],
+            "embeddings": torch.from_numpy(matrix),
+            "stats": stats,
+        }
+
+
+class ShardedEmbeddingStore:
+    """
+    Crash-safe streaming store for embedding a large vocabulary.
+
+    Rows are appended as `.npy` shards under `{root}/{name}/`; a shard only
+    counts once `manifest.json` lists it, and both are replaced atomically, so
+    after a crash `resume_from` points right after the last complete shard.
+    `finalize` stitches the shards into one `matrix.npy` that is opened
+    memory-mapped. The store is tied to the checkpoint and to every input's
+    path, size and mtime; any change starts it over.
+    """
+
+    def __init__(self, root, name, input_paths, dtype = "float32", checkpoint = ""):
+        self.dir = os.path.join(root, name)
+        self.manifest_path = os.path.join(self.dir, "manifest.json")
+        self.matrix_path = os.path.join(self.dir, "matrix.npy")
+        self.input_paths = list(input_paths)
+        self.dtype = np.dtype(dtype)
+        h = hashlib.sha1(checkpoint.encode())
+        for path in self.input_paths:
+            h.update(("\n" + stat_id(path)).encode())
+        inputs_hash = h.hexdigest()
+
+        os.makedirs(self.dir, exist_ok = True)
+        self.manifest = {"inputs": inputs_hash, "dtype": self.dtype.name, "shards": [], "complete": False}
+        manifest = read_json(self.manifest_path)
+        if manifest is not None:
+            # a different vocabulary, checkpoint or dtype cannot be resumed
+            if manifest["inputs"] == inputs_hash and manifest["dtype"] == self.dtype.name:
+                self.manifest = manifest
+
+    @property
+    def resume_from(self):
+        return self.manifest["shards"][-1]["end"] if self.manifest["shards"] else 0
+
+    def append(self, embeddings):
+        """Persist the next rows (torch.Tensor or np.ndarray) as one shard."""
+        rows = np.asarray(torch.as_tensor(embeddings).float().cpu().numpy(), dtype = self.dtype)
+        start = self.resume_from
+        name = f"shard_{len(self.manifest['shards']):05d}.npy"
+
+        with atomic_write(os.path.join(self.dir, name), ".npy") as tmp:
+            np.save(tmp, rows)
+        self.manifest["shards"].append({"file": name, "start": start, "end": start + len(rows)})
+        write_json(self.manifest_path, self.manifest)
+
+    def finalize(self):
+        """
+        Returns:
+            np.ndarray (n, d): memory-mapped matrix of all rows in input order.
+        """
+        if not self.manifest["complete"]:
+            if self.resume_from != len(self.input_paths):
+                raise RuntimeError(f"Store holds {self.resume_from} of {len(self.input_paths)} rows.")
+            first = np.load(os.path.join(self.dir, self.manifest["shards"][0]["file"]), mmap_mode = "r")
+            with atomic_write(self.matrix_path, ".npy") as tmp:
+                matrix = np.lib.format.open_memmap(tmp, mode = "w+", dtype = self.dtype, shape = (len(self.input_paths), first.shape[1]))
+                for shard in self.manifest["shards"]:
+                    matrix[shard["start"]:shard["end"]] = np.load(os.path.join(self.dir, shard["file"]), mmap_mode = "r")
+                matrix.flush()
+                del matrix
+
+            self.manifest["complete"] = True
+            write_json(self.manifest_path, self.manifest)
+            for shard in self.manifest["shards"]:
+                os.remove(os.path.join(self.dir, shard["file"]))
+
+        return np.load(self.matrix_path, mmap_mode = "c")
+
+
+class QueryEmbeddingCache:
+    """
+    Persistent LRU cache of text embeddings keyed by (checkpoint, normalized
+    text), so reruns and parameter sweeps over the same questions skip the
+    text encoder.
+
+    Each checkpoint gets `{root}/{checkpoint hash}/` with `embeddings.npy` and
+    `lru.json` (an LRUManifest, text key -> row and last access). The cache is
+    loaded into memory once and written back after every `embed`; past
+    `max_entries` the least recently used texts are dropped.
+    """
+
+    def __init__(self, root, checkpoint, max_entries = 20000):
+        self.max_entries = max_entries
+        self.dir = os.path.join(root, hashlib.sha1(checkpoint.encode()).hexdigest()[:16])
+        self.matrix_path = os.path.join(self.dir, "embeddings.npy")
+        self.lru = LRUManifest(os.path.join(self.dir, "lru.json"))
+        self.stats = self.lru.stats
+
+        self._rows = None
+        if os.path.exists(self.matrix_path):
+            self._rows = np.load(self.matrix_path)
+        else:
+            self.lru.entries = {}
+
+    @staticmethod
+    def checkpoint_id(model_path):
+        """Identify a checkpoint by its `stat_id` (or the pretrained default)."""
+        if model_path is None:
+            return "imagebind_huge:pretrained"
+        return stat_id(model_path)
+
+    @staticmethod
+    def normalize(text):
+        # the ImageBind tokenizer lowercases and collapses whitespace itself
+        return " ".join(text.split()).lower()
+
+    def embed(self, texts, embed_fn):
+        """
+        Args:
+            texts (list): Query texts.
+            embed_fn (callable): list of texts -> torch.Tensor (n, d).
+        Returns:
+            torch.Tensor (n, d): Embeddings in input order.
+        """
+        keys = [self.normalize(text) for text in texts]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.lru))
+        hits = sum(key in self.lru for key in keys)
+        self.stats["hits"] += hits
+        self.stats["misses"] += len(keys) - hits
+
+        if missing:
+            new_rows = embed_fn(missing).float().cpu().numpy()
+            base = 0 if self._rows is None else len(self._rows)
+            self._rows = new_rows if self._rows is None else np.concatenate([self._rows, new_rows])
+            for offset, key in enumerate(missing):
+                self.lru.touch(key, row = base + offset)
+
+        out = torch.from_numpy(self._rows[[self.lru[key]["row"] for key in keys]])
+        for key in keys:
+            self.lru.touch(key)
+        if missing and self.lru.evict(max_entries = self.max_entries):
+            # compact the surviving rows
+            keys = list(self.lru.entries)
+            self._rows = self._rows[[self.lru[key]["row"] for key in keys]]
+            for row, key in enumerate(keys):
+                self.lru[key]["row"] = row
+        self._save(rows = bool(missing))
+        return out
+
+    def _save(self, rows = True):
+        os.makedirs(self.dir, exist_ok = True)
+        if rows:
+            with atomic_write(self.matrix_path, ".npy") as tmp:
+                np.save(tmp, self._rows)
+        self.lru.save()
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+from .cache_utils import LRUManifest, atomic_write, stat_id
+
+# environment variables qwen_omni_utils reads when decoding video
+VIDEO_ENV_SETTINGS = ("FORCE_QWENVL_VIDEO_READER", "VIDEO_MAX_PIXELS")
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.numel()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class MMPreprocessCache:
+    """
+    Two-tier LRU cache of `process_mm_info` outputs (decoded audio waveforms,
+    sampled video frames, images) for one input's media, keyed by every media
+    file's `stat_id` plus the processing settings.
+
+    Entries are kept in memory up to `mem_max_bytes` and, with `root` set, as
+    `{key}.pt` files on disk up to `disk_max_bytes` (an LRUManifest, `lru.json`).
+    A memory miss falls back to disk and then to `process_fn`.
+    """
+
+    def __init__(self, root = None, mem_max_bytes = 8 * 2 ** 30, disk_max_bytes = 100 * 2 ** 30, settings = None):
+        self.root = root
+        self.mem_max_bytes = mem_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.settings = dict(settings or {}, **{name: os.environ.get(name) for name in VIDEO_ENV_SETTINGS})
+        self._memory = OrderedDict()  # key -> (entry, nbytes), most recent last
+        self._memory_bytes = 0
+        if root is not None:
+            os.makedirs(root, exist_ok = True)
+        self._lru = LRUManifest(os.path.join(root, "lru.json") if root is not None else None)
+        self.stats = self._lru.stats
+        self.stats.update(memory_hits = 0, disk_hits = 0)
+
+    def key(self, media):
+        """media: list of content elements, e.g. {"type": "video", "video": path}."""
+        parts = [json.dumps(self.settings, sort_keys = True)]
+        for element in media:
+            parts.append("{}:{}".format(element["type"], stat_id(element[element["type"]])))
+        return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+    def get(self, media, process_fn):
+        """
+        Args:
+            media (list): One input's media content elements.
+            process_fn (callable): media -> (audios, images, videos) lists.
+        Returns:
+            (audios, images, videos): lists for this input, in element order.
+        """
+        key = self.key(media)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["memory_hits"] += 1
+            return self._memory[key][0]
+
+        entry = self._load(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            entry = process_fn(media)
+            self._save(key, entry)
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        nbytes = _nbytes(entry)
+        self._memory[key] = (entry, nbytes)
+        self._memory_bytes += nbytes
+        while self._memory_bytes > self.mem_max_bytes and len(self._memory) > 1:
+            _, (_, dropped) = self._memory.popitem(last = False)
+            self._memory_bytes -= dropped
+            self.stats["evictions"] += 1
+
+    def _load(self, key):
+        if self.root is None or key not in self._lru:
+            return None
+        path = os.path.join(self.root, f"{key}.pt")
+        if not os.path.exists(path):
+            self._lru.pop(key)
+            return None
+        # our own files; they hold numpy waveforms next to tensors
+        entry = torch.load(path, weights_only = False)
+        self._lru.touch(key)
+        self._lru.save()
+        return entry
+
+    def _save(self, key, entry):
+        if self.root is None:
+            return
+        path = os.path.join(self.root, f"{key}.pt")
+        with atomic_write(path) as tmp:
+            torch.save(entry, tmp)
+        self._lru.touch(key, os.path.getsize(path))
+
+        for old in self._lru.evict(max_bytes = self.disk_max_bytes, keep = {key}):
+            os.remove(os.path.join(self.root, f"{old}.pt"))
+        self._lru.save()
@@ -0,0 +1,165 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+
+class ExactIndex:
+    """
+    Exact inner-product top-k. The vocabulary is scored in blocks of
+    `block_size` rows and a running top-k is kept, so the full
+    (queries, vocabulary) score matrix never exists at once. Blocks are
+    scored in float32 even when the vocabulary is stored in float16.
+    """
+
+    def __init__(self, vocabs, block_size = 65536):
+        self.vocabs = torch.as_tensor(vocabs)
+        self.block_size = block_size
+
+    def search(self, queries, k = 1):
+        queries = torch.as_tensor(queries).float()
+        k = min(k, len(self.vocabs))
+        best_scores, best_indices = None, None
+        for start in range(0, len(self.vocabs), self.block_size):
+            scores = queries @ self.vocabs[start:start + self.block_size].float().T
+            scores, indices = torch.topk(scores, k = min(k, scores.shape[1]), dim = -1)
+            indices = indices + start
+            if best_scores is not None:
+                scores = torch.cat((best_scores, scores), dim = -1)
+                indices = torch.cat((best_indices, indices), dim = -1)
+                scores, order = torch.topk(scores, k = min(k, scores.shape[1]), dim = -1)
+                indices = torch.gather(indices, -1, order)
+            best_scores, best_indices = scores, indices
+        return best_indices
+
+
+class IVFIndex:
+    """
+    Inverted-file ANN index in NumPy: k-means splits the vocabulary into
+    `nlist` lists; a query scores the centroids, scans the `nprobe` best lists
+    exactly, and probes further lists only if they hold fewer than k rows.
+    """
+
+    def __init__(self, vocabs, nlist = None, nprobe = 8, iters = 10, seed = 0):
+        self.vocabs = torch.as_tensor(vocabs).float().cpu().numpy()
+        n = len(self.vocabs)
+        self.nlist = min(nlist or max(1, int(np.sqrt(n))), n)
+        self.nprobe = nprobe
+
+        rng = np.random.default_rng(seed)
+        centroids = self.vocabs[rng.choice(n, self.nlist, replace = False)]
+        for _ in range(iters):
+            assign = self._assign(centroids)
+            for c in range(self.nlist):
+                members = self.vocabs[assign == c]
+                if len(members):
+                    centroids[c] = members.mean(0)
+        self.centroids = centroids
+        assign = self._assign(centroids)
+        self.lists = [np.flatnonzero(assign == c) for c in range(self.nlist)]
+
+    def _assign(self, centroids):
+        # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+        return np.argmax(self.vocabs @ centroids.T - 0.5 * (centroids ** 2).sum(1), axis = 1)
+
+    def search(self, queries, k = 1):
+        queries = torch.as_tensor(queries).float().cpu().numpy()
+        k = min(k, len(self.vocabs))
+        order = np.argsort(-(queries @ self.centroids.T), axis = 1)
+
+        results = np.empty((len(queries), k), dtype = np.int64)
+        for qi, query in enumerate(queries):
+            probe = self.nprobe
+            candidates = np.concatenate([self.lists[c] for c in order[qi, :probe]])
+            while len(candidates) < k:
+                candidates = np.concatenate((candidates, self.lists[order[qi, probe]]))
+                probe += 1
+            scores = self.vocabs[candidates] @ query
+            top = np.argpartition(-scores, k - 1)[:k]
+            results[qi] = candidates[top[np.argsort(-scores[top], kind = "stable")]]
+        return torch.from_numpy(results)
+
+
+class FaissHNSWIndex:
+    """HNSW inner-product index backed by faiss (optional dependency)."""
+
+    def __init__(self, vocabs, m = 32, ef_search = 64):
+        import faiss
+
+        self.size = len(vocabs)
+        vocabs = np.ascontiguousarray(torch.as_tensor(vocabs).float().cpu().numpy())
+        self.index = faiss.IndexHNSWFlat(vocabs.shape[1], m, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efSearch = ef_search
+        self.index.add(vocabs)
+
+    def search(self, queries, k = 1):
+        queries = np.ascontiguousarray(torch.as_tensor(queries).float().cpu().numpy())
+        _, indices = self.index.search(queries, min(k, self.size))
+        return torch.from_numpy(indices)
+
+
+INDEX_BACKENDS = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+    "hnsw": FaissHNSWIndex,
+}
+
+
+def build_index(vocabs, backend = "exact", **kwargs):
+    if backend not in INDEX_BACKENDS:
+        raise NotImplementedError(f"Unknown index backend {backend}, choose from {list(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](vocabs, **kwargs)
+
+
+def benchmark(vocabs, queries, k = 10, configs = None):
+    """
+    Recall@k against the exact index and per-query latency for each
+    (backend, kwargs) in `configs`.
+
+    Returns:
+        List of dicts: {backend, kwargs, build_s, ms_per_query, recall}.
+    """
+    configs = configs or [("exact", {}), ("ivf", {"nprobe": 1}), ("ivf", {"nprobe": 8}), ("ivf", {"nprobe": 32})]
+    truth = ExactIndex(vocabs).search(queries, k = k).numpy()
+
+    rows = []
+    for backend, kwargs in configs:
+        try:
+            t0 = time.time()
+            index = build_index(vocabs, backend, **kwargs)
+            t1 = time.time()
+            found = index.search(queries, k = k).numpy()
+            t2 = time.time()
+        except ImportError as e:
+            print(f"skip {backend}: {e}")
+            continue
+        recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        rows.append({
+            "backend": backend,
+            "kwargs": kwargs,
+            "build_s": t1 - t0,
+            "ms_per_query": 1000 * (t2 - t1) / len(queries),
+            "recall": recall,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of AVRAG index backends")
+    parser.add_argument("--vocab_size", type=int, default=100000, help="Number of vocabulary rows.")
+    parser.add_argument("--num_queries", type=int, default=1000, help="Number of queries.")
+    parser.add_argument("--dim", type=int, default=1024, help="Embedding size (ImageBind-huge is 1024).")
+    parser.add_argument("--topk", type=int, default=10, help="k for recall@k.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # clustered synthetic data, closer to real embeddings than isotropic noise
+    centers = rng.normal(size = (256, args.dim)).astype(np.float32)
+    vocabs = centers[rng.integers(0, 256, args.vocab_size)] + 0.5 * rng.normal(size = (args.vocab_size, args.dim)).astype(np.float32)
+    queries = centers[rng.integers(0, 256, args.num_queries)] + 0.5 * rng.normal(size = (args.num_queries, args.dim)).astype(np.float32)
+
+    configs = [("exact", {}), ("ivf", {"nprobe": 1}), ("ivf", {"nprobe": 8}), ("ivf", {"nprobe": 32}), ("hnsw", {})]
+    for row in benchmark(torch.from_numpy(vocabs), torch.from_numpy(queries), k = args.topk, configs = configs):
+        print(f"{row['backend']:>6} {str(row['kwargs']):<16} build {row['build_s']:7.2f}s  "
+              f"{row['ms_per_query']:8.3f} ms/query  recall@{args.topk} {row['recall']:.3f}")
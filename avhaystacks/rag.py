@@ -6,31 +6,99 @@ import argparse
 from model.avrag import AVRAG
 from imagebind.models.imagebind_model import ModalityType
 
+def align_vocabs(v_embed, a_embed):
+    """Keep only files present in both vocabs, in the same row order."""
+    if v_embed["filename"] == a_embed["filename"]:
+        return v_embed, a_embed
+
+    audio_rows = {name: row for row, name in enumerate(a_embed["filename"])}
+    common = [(row, audio_rows[name]) for row, name in enumerate(v_embed["filename"]) if name in audio_rows]
+    v_rows = [row for row, _ in common]
+    a_rows = [row for _, row in common]
+    print(f"Aligned vocabs: {len(common)} shared files ({len(v_embed['filename'])} video, {len(a_embed['filename'])} audio)")
+    return (
+        {"filename": [v_embed["filename"][i] for i in v_rows], "embeddings": v_embed["embeddings"][v_rows]},
+        {"filename": [a_embed["filename"][i] for i in a_rows], "embeddings": a_embed["embeddings"][a_rows]},
+    )
+
+def retrieval_recall(sources, retrieved):
+    """Mean fraction of each question's ground-truth files (timestamps keys) that were retrieved."""
+    recalls = []
+    for source, files in zip(sources, retrieved):
+        truth = {'.'.join(name.split('.')[:-1]) for name in source.get("timestamps", {})}
+        if truth:
+            recalls.append(len(truth & set(files)) / len(truth))
+    return sum(recalls) / len(recalls) if recalls else float("nan")
+
+def sweep(args, rag, sources, queries, t_embed, v_embed, a_embed):
+    """Write one retrieval file per (mode, alpha_v) setting plus a recall summary."""
+    alphas = [float(alpha) for alpha in args.sweep_alphas.split(",")]
+    modes = args.sweep_modes.split(",")
+    results = rag.joint_rag_sweep(t_embed, v_embed, a_embed, k = args.topk, alphas = alphas, modes = modes, rrf_k = args.rrf_k)
+
+    stem, ext = os.path.splitext(args.output)
+    summary = {}
+    for name, setting_results in results.items():
+        retrieved = [res[query] for query, res in zip(queries, setting_results)]
+        targets = [dict(source, retrieved_file = files) for source, files in zip(sources, retrieved)]
+        with open(f"{stem}_{name}{ext}", 'w') as f:
+            json.dump(targets, f, indent=2)
+        summary[name] = retrieval_recall(sources, retrieved)
+        print(f"{name}: recall@{args.topk} {summary[name]:.4f}")
+
+    with open(f"{stem}_sweep{ext}", 'w') as f:
+        json.dump(summary, f, indent=2)
+
 def main(args):
 
     with open(args.annotations, "r") as f:
         sources = json.load(f)
 
-    rag = AVRAG(model_path = args.model_path, bsz = args.bsz)
+    rag = AVRAG(model_path = args.model_path, bsz = args.bsz, index_backend = args.index_backend, index_kwargs = json.loads(args.index_kwargs), num_workers = args.num_workers, queue_depth = args.queue_depth, fp16_storage = args.fp16, embed_procs = args.embed_procs, query_cache_dir = args.query_cache)
 
-    if args.cache:
+    if args.cache and args.index_dir is None:
         video_paths = os.path.join(os.path.dirname(args.video_vocabs), "video_embeddings.pt")
         audio_paths = os.path.join(os.path.dirname(args.audio_vocabs), "audio_embeddings.pt")
+        for cache_file, vocab_dir in ((video_paths, args.video_vocabs), (audio_paths, args.audio_vocabs)):
+            newest = max(os.path.getmtime(os.path.join(vocab_dir, f)) for f in os.listdir(vocab_dir))
+            if newest > os.path.getmtime(cache_file):
+                print(f"Warning: {cache_file} is older than files in {vocab_dir}; use --index_dir to refresh it incrementally.")
     else:
-        video_paths = [os.path.join(args.video_vocabs, video) for video in os.listdir(args.video_vocabs) if video.endswith(".mp4")]
-        audio_paths = [os.path.join(args.audio_vocabs, audio) for audio in os.listdir(args.audio_vocabs) if audio.endswith(".m4a") or audio.endswith(".wav")]
+        video_paths = sorted(os.path.join(args.video_vocabs, video) for video in os.listdir(args.video_vocabs) if video.endswith(".mp4"))
+        audio_paths = sorted(os.path.join(args.audio_vocabs, audio) for audio in os.listdir(args.audio_vocabs) if audio.endswith(".m4a") or audio.endswith(".wav"))
     
-    v_embed = rag.encode(video_paths, ModalityType.VISION, cache = args.cache)
-    a_embed = rag.encode(audio_paths, ModalityType.AUDIO, cache = args.cache)
+    use_cache = args.cache and args.index_dir is None
+    v_embed = rag.encode(video_paths, ModalityType.VISION, cache = use_cache, index_dir = args.index_dir, stream_dir = args.stream_dir)
+    a_embed = rag.encode(audio_paths, ModalityType.AUDIO, cache = use_cache, index_dir = args.index_dir, stream_dir = args.stream_dir)
+    v_embed, a_embed = align_vocabs(v_embed, a_embed)
+
+    # encode every question in bsz chunks and retrieve them with one score matrix
+    queries = [source["question"] for source in sources]
+    t_embed = rag.encode(queries, ModalityType.TEXT)
+
+    if args.sweep_alphas is not None or args.sweep_modes is not None:
+        assert args.level == "video", "Sweeps are only supported with --level video."
+        args.sweep_alphas = args.sweep_alphas or str(args.alpha_v)
+        args.sweep_modes = args.sweep_modes or args.mode
+        sweep(args, rag, sources, queries, t_embed, v_embed, a_embed)
+        return
 
     targets = []
-    for source in sources:
-        query = source["question"]
-        t_embed = rag.encode(query, ModalityType.TEXT)
-        res = rag.joint_rag(t_embed, v_embed, a_embed, k = args.topk, alpha_v = args.alpha_v, mode = args.mode)
-        res = res[0]
-        source["retrieved_file"] = res[query]
-        targets.append(source)
+    if args.level in ("segment", "hierarchical"):
+        # vocabs are clipping.py segments; keep the best segments of the top videos
+        if args.level == "segment":
+            results = rag.segment_rag(t_embed, v_embed, a_embed, k = args.topk, segments_per_video = args.segments_per_video, alpha_v = args.alpha_v)
+        else:
+            results = rag.hierarchical_rag(t_embed, v_embed, a_embed, k = args.topk, shortlist = args.shortlist, segments_per_video = args.segments_per_video, alpha_v = args.alpha_v)
+        for source, query, res in zip(sources, queries, results):
+            source["retrieved_file"] = list(res[query])
+            source["retrieved_segments"] = res[query]
+            targets.append(source)
+    else:
+        results = rag.joint_rag(t_embed, v_embed, a_embed, k = args.topk, alpha_v = args.alpha_v, mode = args.mode, rrf_k = args.rrf_k)
+        for source, query, res in zip(sources, queries, results):
+            source["retrieved_file"] = res[query]
+            targets.append(source)
 
     with open(args.output, 'w') as f:
         json.dump(targets, f, indent=2)
@@ -44,9 +112,24 @@ if __name__ == "__main__":
     args.add_argument("--video_vocabs", type=str, default="./data/test/original-videos", help="Path to the video vocab.")
     args.add_argument("--audio_vocabs", type=str, default="./data/test/original-audio", help="Path to the audio vocab.")
     args.add_argument("--bsz", type=int, default=1, help="Batch size.")
+    args.add_argument("--num_workers", type=int, default=0, help="Workers loading media batches ahead of the model (0: main thread).")
+    args.add_argument("--queue_depth", type=int, default=2, help="Batches loaded ahead of the model when num_workers > 0.")
+    args.add_argument("--embed_procs", type=int, default=0, help="Embed vocabs with this many CPU model replicas (separate processes).")
+    args.add_argument("--fp16", action="store_true", help="Store vocab embeddings (and the index) in float16.")
     args.add_argument("--cache", action="store_true", help="Use cache.")
-    args.add_argument("--mode", type=str, default="0", help="Mode.")
+    args.add_argument("--index_dir", type=str, default=None, help="Persistent embedding index; only new or changed vocab files are embedded.")
+    args.add_argument("--query_cache", type=str, default=None, help="Persistent query-text embedding cache, reused across runs and sweeps.")
+    args.add_argument("--stream_dir", type=str, default=None, help="Stream vocab embeddings to a resumable sharded store instead of memory.")
+    args.add_argument("--index_backend", type=str, default="exact", help="Vocabulary search: exact / ivf / hnsw (faiss).")
+    args.add_argument("--index_kwargs", type=str, default="{}", help='Backend options as JSON, e.g. \'{"nlist": 1024, "nprobe": 16}\' for ivf or \'{"m": 32, "ef_search": 128}\' for hnsw.')
+    args.add_argument("--mode", type=str, default="0", help="Mode: 0 joint embedding, 1 vision + audio union, 2 normalized score fusion, 3 reciprocal rank fusion.")
+    args.add_argument("--rrf_k", type=int, default=60, help="Rank offset k in reciprocal rank fusion (mode 3).")
+    args.add_argument("--sweep_alphas", type=str, default=None, help="Comma-separated alpha_v values to sweep in one run, e.g. 0,0.25,0.5,0.75,1.")
+    args.add_argument("--sweep_modes", type=str, default=None, help="Comma-separated modes to sweep, e.g. 0,2,3.")
     args.add_argument("--topk", type=int, default=1, help="Number of top results to return.")
+    args.add_argument("--level", type=str, default="video", choices=["video", "segment", "hierarchical"], help="Retrieve whole videos, or segments when the vocabs are clipping.py outputs (hierarchical: video shortlist, then segment rerank).")
+    args.add_argument("--shortlist", type=int, default=10, help="Videos kept by the first stage of hierarchical retrieval.")
+    args.add_argument("--segments_per_video", type=int, default=2, help="Segments kept per retrieved video at segment level.")
     args.add_argument("--alpha_v", type=float, default=0.5, help="The importance of vision compared to audio.")
     args = args.parse_args()
 